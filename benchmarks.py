@@ -0,0 +1,243 @@
+#!/usr/local/bin/python3
+# c-basic-offset: 4; tab-width: 4; indent-tabs-mode: nil
+# vi: set shiftwidth=4 tabstop=4 expandtab
+# :indentSize=4:tabSize=4:noTabs=true
+
+"""
+Benchmarks of the computational kernels of all three exercises.
+
+    python3 benchmarks.py run        # time everything, append to history
+    python3 benchmarks.py compare    # last run against the one before
+    python3 benchmarks.py check      # instrumentation agrees across backends
+
+Each workload is run at several problem sizes. For each, the best and
+median wall time of a few repeats are recorded, along with the peak
+memory allocated during one further run. Memory is traced in that run
+only, as tracing slows allocation down. Tracing only sees this process,
+so that run uses the serial backend wherever a workload would use a
+process pool: the peak is that of the work done one task at a time.
+"""
+
+import sys
+from argparse import ArgumentParser
+from datetime import datetime
+from functools import partial
+from json import dump, load
+from os.path import abspath, dirname, exists, join
+from platform import python_version
+from statistics import median
+from subprocess import run
+from time import perf_counter
+from tracemalloc import start, stop, get_traced_memory
+
+root = dirname(abspath(__file__))
+for exercise in ['exercise1', 'exercise2', 'exercise3']:
+    sys.path.insert(0, join(root, exercise))
+
+from numpy import linspace
+from common import executor, instrumentation
+import cornu_spiral_plotter
+import monte_carlo_integrator
+import helmholtz
+from MechanicalSystems import Pendulum
+
+HISTORY = join(root, 'benchmarks.json')
+
+
+def helmholtz_field(n):
+    coils = [helmholtz.CircularWire(centre_location=[0, 0, z])
+             for z in [-0.5, 0.5]]
+    helmholtz.superimpose(coils, helmholtz.generate_yz_space(n=n))
+
+
+def monte_carlo_integrate(n, precision='double'):
+    monte_carlo_integrator.monte_carlo_integrate(n, stats=True,
+                                                 precision=precision)
+
+
+def segment_field(n, precision='double'):
+    coil = helmholtz.CircularWire(resolution=2**8, kernel='segment')
+    helmholtz.field(coil, helmholtz.generate_yz_space(n=n),
+                    precision=precision)
+
+
+def monte_carlo_integrate_many(n):
+    monte_carlo_integrator.monte_carlo_integrate_many(
+        n, [monte_carlo_integrator.f_example]*4)
+
+
+def find_best_value_mp(n):
+    monte_carlo_integrator.find_best_value_mp(n, 25, stats=True)
+
+
+def fresnel(n):
+    cornu_spiral_plotter.map_to_array_mp(cornu_spiral_plotter.fresnel_c,
+                                         linspace(-20, 20, n))
+
+
+def cornu_points(rng):
+    for _ in cornu_spiral_plotter.cornu_points(rng):
+        pass
+
+
+def pendulum_simulate(duration):
+    Pendulum(q=0.5, f=1.2).simulate(rate=500, duration=duration)
+
+
+# name: (workload, problem sizes)
+WORKLOADS = {
+    'helmholtz.superimpose': (helmholtz_field, [10, 20, 30]),
+    'monte_carlo_integrate': (monte_carlo_integrate, [10**4, 10**5, 10**6]),
+    'monte_carlo_integrate.single': (
+        partial(monte_carlo_integrate, precision='single'),
+        [10**4, 10**5, 10**6]),
+    'monte_carlo_integrate_many': (monte_carlo_integrate_many,
+                                   [10**4, 10**5, 10**6]),
+    'helmholtz.field': (segment_field, [10, 20, 30]),
+    'helmholtz.field.single': (partial(segment_field, precision='single'),
+                               [10, 20, 30]),
+    'find_best_value_mp': (find_best_value_mp, [10**3, 10**4, 10**5]),
+    'fresnel_c': (fresnel, [2**8, 2**10, 2**12]),
+    'cornu_points': (cornu_points, [20, 100, 200]),
+    'Pendulum.simulate': (pendulum_simulate, [100, 1000, 5000]),
+}
+
+
+def measure(workload, size, repeats=3):
+    """Time workload(size) repeats times, after one warm-up call, then
+    run it once more, serially, with memory traced, since tracing slows
+    it down."""
+    workload(size)
+    times = []
+    for _ in range(repeats):
+        begin = perf_counter()
+        workload(size)
+        times.append(perf_counter() - begin)
+    previous, executor.default_backend = executor.default_backend, 'serial'
+    start()
+    try:
+        workload(size)
+        _, peak = get_traced_memory()
+    finally:
+        stop()
+        executor.default_backend = previous
+    return {'best': min(times), 'median': median(times), 'peak_bytes': peak}
+
+
+def current_commit():
+    result = run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root,
+                 capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+
+def load_history(path=HISTORY):
+    if not exists(path):
+        return []
+    with open(path) as f:
+        return load(f)
+
+
+def run_benchmarks(names=None, repeats=3, path=HISTORY):
+    """Run the selected workloads, print and record the results."""
+    results = {}
+    for name, (workload, sizes) in WORKLOADS.items():
+        if names and name not in names:
+            continue
+        results[name] = {}
+        for size in sizes:
+            r = measure(workload, size, repeats)
+            results[name][str(size)] = r
+            print(f'{name:24} {size:>9} {r["best"]:10.4f} s '
+                  f'{r["peak_bytes"]/2**20:9.2f} MiB')
+    history = load_history(path)
+    history.append({'date': datetime.now().isoformat(timespec='seconds'),
+                    'commit': current_commit(),
+                    'python': python_version(),
+                    'results': results})
+    with open(path, 'w') as f:
+        dump(history, f, indent=1)
+    return results
+
+
+def compare(new=-1, old=-2, threshold=0.1, path=HISTORY):
+    """
+    Compare two runs from the history, and report the workloads that got
+    slower by more than threshold (as a fraction).
+
+    Returns
+    -------
+    list of (name, size, ratio) for every regression.
+    """
+    history = load_history(path)
+    if len(history) < 2:
+        print('Need at least two runs to compare.')
+        return []
+    before, after = history[old], history[new]
+    print(f'{before["commit"]} ({before["date"]}) -> '
+          f'{after["commit"]} ({after["date"]})')
+    regressions = []
+    for name, sizes in after['results'].items():
+        for size, r in sizes.items():
+            if size not in before['results'].get(name, {}):
+                continue
+            ratio = r['best']/before['results'][name][size]['best']
+            flag = ''
+            if ratio > 1 + threshold:
+                flag = 'SLOWER'
+                regressions.append((name, size, ratio))
+            elif ratio < 1 - threshold:
+                flag = 'faster'
+            print(f'{name:24} {size:>9} {ratio:8.2f}x {flag}')
+    return regressions
+
+
+def check_instrumentation(backends=('serial', 'thread', 'process')):
+    """
+    Record the same call to helmholtz.field with every backend, and report
+    whether the calls and items counted for it agree.
+
+    Returns
+    -------
+    list of (backend, calls, items) that differ from the serial backend.
+    """
+    coil = helmholtz.CircularWire(resolution=16)
+    points = helmholtz.generate_yz_space(n=5)
+    counts = {}
+    for backend in backends:
+        with instrumentation.recording():
+            helmholtz.field(coil, points, backend=backend)
+        s = instrumentation.summary()['field']
+        counts[backend] = (s['calls'], s['items'])
+        print(f'{backend:24} {s["calls"]:>9} calls {s["items"]:>9} items')
+    return [(backend,) + c for backend, c in counts.items()
+            if c != counts[backends[0]]]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('names', nargs='*',
+                            help='workloads to run, all by default: ' +
+                            ', '.join(WORKLOADS))
+    run_parser.add_argument('--repeats', type=int, default=3)
+    compare_parser = commands.add_parser('compare',
+                                         help='compare two recorded runs')
+    compare_parser.add_argument('--new', type=int, default=-1,
+                                help='index of the run in the history')
+    compare_parser.add_argument('--old', type=int, default=-2)
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='relative slowdown to flag')
+    commands.add_parser('check', help='check that instrumentation counts '
+                        'agree across backends')
+    arguments = parser.parse_args()
+    if arguments.command == 'run':
+        unknown = set(arguments.names) - set(WORKLOADS)
+        if unknown:
+            parser.error('unknown workloads: ' + ', '.join(unknown))
+        run_benchmarks(arguments.names, arguments.repeats)
+    elif arguments.command == 'check':
+        sys.exit(1 if check_instrumentation() else 0)
+    else:
+        sys.exit(1 if compare(arguments.new, arguments.old,
+                              arguments.threshold) else 0)
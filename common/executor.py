@@ -0,0 +1,122 @@
+#!/usr/local/bin/python3
+# c-basic-offset: 4; tab-width: 4; indent-tabs-mode: nil
+# vi: set shiftwidth=4 tabstop=4 expandtab
+# :indentSize=4:tabSize=4:noTabs=true
+
+"""
+One place to decide how work is spread over processors.
+
+Pools are created on first use and kept until the interpreter exits, so
+that repeated calls, e.g. one per point of a parameter sweep, do not pay
+for starting processes every time.
+
+Backends
+--------
+serial
+in the calling thread. No overhead, useful for small tasks and
+debugging.
+
+thread
+a pool of threads. Only helps if the work releases the GIL, as large
+numpy operations do.
+
+process
+a pool of processes. Arguments and results are pickled, so the function
+must be defined at module level (or be a partial of one, or a bound
+method of a picklable object).
+"""
+
+from atexit import register
+from math import ceil
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool, ThreadPool
+from numpy import array
+from numpy.random import seed
+from common.instrumentation import instrumented
+
+default_backend = 'process'
+_pools = {}
+
+
+def _reseed():
+    """Forked workers inherit the parent's random state, so would all
+    draw the same numbers."""
+    seed()
+
+
+def get_pool(backend=None, workers=None):
+    """Return the persistent pool for backend, creating it if need be."""
+    if backend is None:
+        backend = default_backend
+    if workers is None:
+        workers = cpu_count()
+    key = (backend, workers)
+    if key not in _pools:
+        _pools[key] = start_pool(backend, workers)
+    return _pools[key]
+
+
+@instrumented('pool startup')
+def start_pool(backend, workers):
+    if backend == 'process':
+        return Pool(workers, initializer=_reseed)
+    elif backend == 'thread':
+        return ThreadPool(workers)
+    else:
+        raise ValueError('Unknown backend: ' + str(backend))
+
+
+def chunksize_for(number_of_tasks, workers):
+    """About four chunks per worker: few enough to keep the pickling
+    overhead down, and enough to even out the load."""
+    return max(1, ceil(number_of_tasks/(4*workers)))
+
+
+@instrumented(count=lambda f, args, *rest, **kwargs:
+              len(args) if hasattr(args, '__len__') else 1)
+def parallel_map(f: callable, args: iter, backend: str = None,
+                 workers: int = None, chunksize: int = None) -> list:
+    """
+    Map f over args, in parallel.
+
+    Parameters
+    ----------
+    f: callable
+    args: iterable
+    backend: str, optional
+    'serial', 'thread' or 'process'. Defaults to default_backend.
+    workers: int, optional
+    size of the pool. Defaults to the number of CPUs.
+    chunksize: int, optional
+    number of tasks sent to a worker at a time. Chosen automatically
+    by default.
+
+    Returns
+    -------
+    list of f(arg), in the order of args.
+    """
+    if backend is None:
+        backend = default_backend
+    args = list(args)
+    if backend == 'serial' or len(args) < 2:
+        return list(map(f, args))
+    if workers is None:
+        workers = cpu_count()
+    if chunksize is None:
+        chunksize = chunksize_for(len(args), workers)
+    return get_pool(backend, workers).map(f, args, chunksize)
+
+
+def map_to_array(f: callable, args: iter, backend: str = None,
+                 workers: int = None, chunksize: int = None):
+    """As parallel_map, but collects the results in a numpy array."""
+    return array(parallel_map(f, args, backend, workers, chunksize))
+
+
+@register
+def shutdown() -> None:
+    """Close all pools, waiting for outstanding work."""
+    for pool in _pools.values():
+        pool.close()
+        pool.join()
+    _pools.clear()
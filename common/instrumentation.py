@@ -0,0 +1,167 @@
+#!/usr/local/bin/python3
+# c-basic-offset: 4; tab-width: 4; indent-tabs-mode: nil
+# vi: set shiftwidth=4 tabstop=4 expandtab
+# :indentSize=4:tabSize=4:noTabs=true
+
+"""
+Opt-in timing of the hot paths.
+
+Functions decorated with @instrumented count their calls, wall time and,
+if told how, the number of items (samples, points, evaluations) they
+process. Nothing is recorded unless enable() is called, or the
+environment variable INSTRUMENT is set; when disabled, the cost is one
+test per call.
+
+Calls a function makes to itself, directly or not, are part of the
+outermost call and not counted again, except in the folded stacks.
+
+Only calls made in this process are recorded. Work sent to a process
+pool is recorded in the workers, and lost; use the 'serial' or 'thread'
+backend of common.executor to see inside it.
+
+    with recording():
+        investigate_chaos()
+    print(report())
+    save_folded('chaos.folded')     # for flamegraph.pl or speedscope
+
+For a complete picture, profile(path) runs cProfile, whose output can be
+read by pstats, snakeviz or flameprof.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+from cProfile import Profile
+from functools import wraps
+from json import dump
+from os import environ
+from threading import local, Lock
+from time import perf_counter
+
+enabled = bool(environ.get('INSTRUMENT'))
+_lock = Lock()
+_stack = local()
+calls = defaultdict(int)
+seconds = defaultdict(float)
+items = defaultdict(int)
+# Time spent in each chain of nested instrumented calls, excluding the
+# time spent in the calls nested within it.
+folded = defaultdict(float)
+
+
+def enable() -> None:
+    global enabled
+    enabled = True
+
+
+def disable() -> None:
+    global enabled
+    enabled = False
+
+
+def reset() -> None:
+    for table in [calls, seconds, items, folded]:
+        table.clear()
+
+
+@contextmanager
+def recording():
+    """Record from scratch for the duration of the block."""
+    reset()
+    enable()
+    try:
+        yield
+    finally:
+        disable()
+
+
+def instrumented(name: str = None, count: callable = None):
+    """
+    Decorator to record calls to a function.
+
+    Parameters
+    ----------
+    name: str, optional
+    to record under. Defaults to the qualified name of the function.
+    count: callable, optional
+    given the same arguments as the function, returns the number of
+    items it processes, for throughput. One per call by default.
+    """
+    def decorate(f):
+        label = name or f.__qualname__
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return f(*args, **kwargs)
+            stack = getattr(_stack, 'frames', None)
+            if stack is None:
+                stack = _stack.frames = []
+            # A recursive call is already counted by the outermost one.
+            outermost = all(frame[0] != label for frame in stack)
+            # Each frame is [label, time spent in nested calls]
+            stack.append([label, 0.0])
+            begin = perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - begin
+                path = ';'.join(frame[0] for frame in stack)
+                _, nested = stack.pop()
+                if stack:
+                    stack[-1][1] += elapsed
+                with _lock:
+                    if outermost:
+                        calls[label] += 1
+                        seconds[label] += elapsed
+                        items[label] += count(*args, **kwargs) if count else 1
+                    folded[path] += elapsed - nested
+        return wrapper
+    return decorate
+
+
+def summary() -> dict:
+    """Per function: calls, total seconds, items and items per second."""
+    return {label: {'calls': calls[label],
+                    'seconds': seconds[label],
+                    'items': items[label],
+                    'throughput': items[label]/seconds[label]
+                    if seconds[label] else None}
+            for label in calls}
+
+
+def report() -> str:
+    """Table of the recorded calls, slowest first."""
+    lines = [f'{"function":40} {"calls":>10} {"seconds":>10} '
+             f'{"per call":>10} {"items/s":>12}']
+    for label, s in sorted(summary().items(),
+                           key=lambda entry: -entry[1]['seconds']):
+        throughput = s['throughput'] or 0
+        lines.append(f'{label:40} {s["calls"]:10d} {s["seconds"]:10.4f} '
+                     f'{s["seconds"]/s["calls"]:10.2e} {throughput:12.4g}')
+    return '\n'.join(lines)
+
+
+def save_report(path: str) -> None:
+    """Write the summary as JSON."""
+    with open(path, 'w') as f:
+        dump(summary(), f, indent=1)
+
+
+def save_folded(path: str) -> None:
+    """Write the nested calls in the folded stack format read by
+    flamegraph.pl and speedscope, with times in microseconds."""
+    with open(path, 'w') as f:
+        for stack, elapsed in sorted(folded.items()):
+            f.write(f'{stack} {int(elapsed*1e6)}\n')
+
+
+@contextmanager
+def profile(path: str):
+    """Run the block under cProfile, and dump the statistics to path."""
+    profiler = Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -0,0 +1,188 @@
+#!/usr/local/bin/python3
+# c-basic-offset: 4; tab-width: 4; indent-tabs-mode: nil
+# vi: set shiftwidth=4 tabstop=4 expandtab
+# :indentSize=4:tabSize=4:noTabs=true
+
+"""
+Deferred plotting.
+
+Modules use
+
+    from common.plotting import plt
+
+in place of matplotlib.pyplot. Used interactively it behaves the same,
+except that pyplot is only imported on first use. Between
+start_recording() and stop_recording(), every call made through it (and
+through the figures and axes it returns) is recorded instead, together
+with its array arguments, so that the figures can be saved to a .npz
+artifact and drawn later, elsewhere, by render().
+"""
+
+from functools import partial
+from json import dumps, loads
+from os.path import abspath
+from numpy import ndarray, generic, empty, atleast_1d, asarray, load, savez
+
+_recorder = None
+
+
+def _pyplot():
+    import matplotlib.pyplot
+    return matplotlib.pyplot
+
+
+class _LazyPyplot:
+    """Stands in for matplotlib.pyplot, or the active recorder."""
+
+    def __getattr__(self, name):
+        if _recorder is not None:
+            return getattr(_recorder.pyplot, name)
+        return getattr(_pyplot(), name)
+
+
+plt = _LazyPyplot()
+
+
+class Recorded:
+    """A figure or axes (or pyplot itself) whose method calls are
+    recorded rather than carried out."""
+
+    def __init__(self, recorder, ident):
+        self._recorder = recorder
+        self._ident = ident
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return partial(self._recorder.call, self._ident, name)
+
+
+def _subplot_shape(args, kwargs):
+    rows = args[0] if len(args) > 0 else kwargs.get('nrows', 1)
+    columns = args[1] if len(args) > 1 else kwargs.get('ncols', 1)
+    return rows, columns
+
+
+class Recorder:
+    """Log of plotting calls, with arrays kept aside."""
+
+    # Methods that return a new figure or axes, which later calls use.
+    constructors = {'figure', 'gcf', 'gca', 'add_subplot', 'twinx', 'twiny'}
+
+    def __init__(self):
+        self.calls = []
+        self.arrays = []
+        self.objects = 1
+        self.pyplot = Recorded(self, 0)
+
+    def new(self):
+        self.objects += 1
+        return Recorded(self, self.objects - 1)
+
+    def encode(self, value):
+        """Make value JSON serialisable."""
+        if isinstance(value, Recorded):
+            return {'__ref__': value._ident}
+        if isinstance(value, ndarray):
+            self.arrays.append(value)
+            return {'__array__': len(self.arrays) - 1}
+        if isinstance(value, generic):
+            return value.item()
+        if isinstance(value, (list, tuple)):
+            return [self.encode(v) for v in value]
+        if isinstance(value, dict):
+            return {'__dict__': {k: self.encode(v) for k, v in value.items()}}
+        return value
+
+    def call(self, target, method, *args, **kwargs):
+        if method == 'savefig' and args and isinstance(args[0], str):
+            # The file belongs where it would have been saved now.
+            args = (abspath(args[0]),) + args[1:]
+        entry = {'target': target, 'method': method,
+                 'args': self.encode(list(args)),
+                 'kwargs': self.encode(kwargs)}
+        result = None
+        if method in self.constructors:
+            result = self.new()
+            entry['returns'] = result._ident
+        elif method == 'subplots':
+            figure = self.new()
+            rows, columns = _subplot_shape(args, kwargs)
+            axes = empty((rows, columns), dtype=object)
+            for index in range(rows*columns):
+                axes.flat[index] = self.new()
+            entry['returns'] = [figure._ident,
+                                [a._ident for a in axes.flat]]
+            if kwargs.get('squeeze', True):
+                axes = axes.squeeze()
+                if axes.ndim == 0:
+                    axes = axes.item()
+            result = figure, axes
+        self.calls.append(entry)
+        return result
+
+    def save(self, path):
+        savez(path, calls=asarray(dumps(self.calls)),
+              **{'a%d' % i: a for i, a in enumerate(self.arrays)})
+
+
+def start_recording() -> Recorder:
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+def stop_recording() -> Recorder:
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def render(path: str) -> str:
+    """
+    Draw the figures recorded in the artifact at path, with a
+    non-interactive backend.
+
+    Returns
+    -------
+    path
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    pyplot = _pyplot()
+    with load(path) as artifact:
+        calls = loads(str(artifact['calls']))
+        arrays = {k: artifact[k] for k in artifact.files}
+    objects = {0: pyplot}
+
+    def decode(value):
+        if isinstance(value, list):
+            return [decode(v) for v in value]
+        if isinstance(value, dict):
+            if '__ref__' in value:
+                return objects[value['__ref__']]
+            if '__array__' in value:
+                return arrays['a%d' % value['__array__']]
+            return {k: decode(v) for k, v in value['__dict__'].items()}
+        return value
+
+    for c in calls:
+        if c['target'] == 0 and c['method'] == 'show':
+            # As if the window had been closed.
+            pyplot.close('all')
+            continue
+        kwargs = decode(c['kwargs'])
+        result = getattr(objects[c['target']], c['method'])(
+            *decode(c['args']), **kwargs)
+        if c['method'] == 'subplots':
+            figure_id, axes_ids = c['returns']
+            figure, axes = result
+            objects[figure_id] = figure
+            if not kwargs.get('squeeze', True):
+                axes = asarray(axes)
+            for ident, a in zip(axes_ids, atleast_1d(axes).flat):
+                objects[ident] = a
+        elif 'returns' in c:
+            objects[c['returns']] = result
+    pyplot.close('all')
+    return path
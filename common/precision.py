@@ -0,0 +1,81 @@
+#!/usr/local/bin/python3
+# c-basic-offset: 4; tab-width: 4; indent-tabs-mode: nil
+# vi: set shiftwidth=4 tabstop=4 expandtab
+# :indentSize=4:tabSize=4:noTabs=true
+
+"""
+Reduced precision arithmetic, for quick exploratory runs.
+
+Kernels that accept precision='single' compute in float32, which halves
+the memory their arrays take and move. Long sums are compensated: each
+block of terms is summed pairwise, and the block sums are accumulated
+with Kahan's algorithm, so that the rounding error does not grow with
+the number of terms. The result then comes back as an Estimate, which
+also holds an estimate of the relative error due to the lower precision.
+"""
+
+from collections import namedtuple
+from math import log2, ceil
+from numpy import float32, float64, finfo, moveaxis, zeros, concatenate, \
+    asarray, ascontiguousarray
+
+dtypes = {'double': float64, 'single': float32}
+
+BLOCK = 2**10
+
+Estimate = namedtuple('Estimate', ['value', 'precision_loss'])
+Estimate.__doc__ = """
+value
+what the kernel returns in double precision.
+
+precision_loss : float
+estimated error due to computing in single precision, relative to the
+magnitude of the value.
+"""
+
+
+def dtype_of(precision: str):
+    """The numpy type for precision, 'double' or 'single'."""
+    try:
+        return dtypes[precision]
+    except KeyError:
+        raise ValueError('Unknown precision: ' + str(precision))
+
+
+def compensated_sum(terms, axis: int = 0, block: int = BLOCK):
+    """
+    Sum of terms along axis, in their own precision, with an error
+    bounded independently of the number of terms.
+
+    Parameters
+    ----------
+    terms : array
+    axis : int, optional
+    block : int, optional
+    number of terms summed pairwise before compensation.
+    """
+    # numpy only sums pairwise along a contiguous last axis; along any
+    # other, it adds the terms one after the other.
+    terms = moveaxis(asarray(terms), axis, -1)
+    n = terms.shape[-1]
+    blocks = max(1, ceil(n/block))
+    if blocks*block != n:
+        padding = zeros(terms.shape[:-1] + (blocks*block - n,),
+                        dtype=terms.dtype)
+        terms = concatenate((terms, padding), axis=-1)
+    partial = ascontiguousarray(terms.reshape(
+        terms.shape[:-1] + (blocks, block))).sum(axis=-1)
+    total = zeros(partial.shape[:-1], dtype=partial.dtype)
+    compensation = zeros(partial.shape[:-1], dtype=partial.dtype)
+    for k in range(blocks):
+        y = partial[..., k] - compensation
+        t = total + y
+        compensation = (t - total) - y
+        total = t
+    return total
+
+
+def summation_error(absolute_sum, dtype, block: int = BLOCK):
+    """Bound on the rounding error of compensated_sum, given the sum of
+    the absolute values of the terms."""
+    return (log2(block) + 2)*finfo(dtype).eps*absolute_sum
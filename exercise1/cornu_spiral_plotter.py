@@ -3,13 +3,17 @@
 # vi: set shiftwidth=4 tabstop=4 expandtab
 # :indentSize=4:tabSize=4:noTabs=true
 
-from multiprocessing.pool import Pool
+import sys
 import scipy.integrate as integrate
-from math import atan2
-from numpy import pi, cos, sin, sqrt, abs, sign, linspace
+from math import atan2, ceil
+from numpy import pi, cos, sin, sqrt, abs, sign, linspace, arange, append, \
+    array, concatenate, cumsum
 from os import mkdir
-from os.path import exists
-import matplotlib.pyplot as plt
+from os.path import exists, abspath, dirname
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from common.executor import map_to_array
+from common.instrumentation import instrumented
+from common.plotting import plt
 
 
 def s_integrand(arg: float):
@@ -22,58 +26,133 @@ def c_integrand(arg: float):
     return cos((pi*arg**2)/2)
 
 
+@instrumented('quad')
 def integral(f: callable, upper_limit: float,
              lower_limit: float = 0) -> tuple():
     """Wrapper function. Pre-applies the integral to shorten the code"""
     return integrate.quad(lambda arg: f(arg), lower_limit, upper_limit)
 
 
+@instrumented()
 def fresnel_c(u: float, lower_limit: float = 0.0) -> tuple():
     """Shorthand function."""
     return integral(c_integrand, u, lower_limit=lower_limit)
 
 
+@instrumented()
 def fresnel_s(u: float, lower_limit: float = 0.0) -> tuple():
     """Shorthand function. """
     return integral(s_integrand, u, lower_limit=lower_limit)
 
 
-def map_to_array_mp(f: callable, args: iter) -> iter:
+def map_to_array_mp(f: callable, args: iter, backend: str = None) -> iter:
     """A multiprocess functional mapping a function to an iterable object
 
     Parameters
     ----------
     f: function
     args: iterable
+    backend: str, optional
+    see common.executor
 
     Returns
     -------
-    list or list of tuples, depending on the output of function.
+    array, or pair of arrays if the function returns pairs.
     """
-    with Pool() as p:
-        xs = p.map(f, args)
-    if isinstance(xs[0], tuple):
-        x1, x2 = [x[0] for x in xs], [x[1] for x in xs]
-        return x1, x2
+    xs = map_to_array(f, args, backend=backend)
+    if xs.ndim > 1:
+        return xs[:, 0], xs[:, 1]
     else:
         return xs
 
 
-def plot_cornu_spiral(rng: float = 20, rate: int = 2**12) -> None:
+def fresnel_increment(limits: tuple) -> tuple:
+    """C and S integrated between limits = (lower, upper)."""
+    lower, upper = limits
+    return (fresnel_c(upper, lower_limit=lower)[0],
+            fresnel_s(upper, lower_limit=lower)[0])
+
+
+def arc_length_samples(limit: float, tolerance: float = 1e-3,
+                       max_step: float = 0.05) -> array:
+    """
+    Values of u from 0 to limit, such that the chords between the
+    points of the spiral deviate from it by no more than tolerance.
+
+    u is the arc length along the spiral, and pi*u its curvature, so a
+    step h deviates by pi*u*h**2/8. Steps are taken as long as that
+    allows, up to max_step.
+    """
+    corner = 8*tolerance/(pi*max_step**2)
+    straight = arange(0, min(corner, limit), max_step)
+    if limit <= corner:
+        return append(straight, limit)
+    # h = c/sqrt(u), so u**1.5 grows by 1.5*c per step.
+    c = sqrt(8*tolerance/pi)
+    steps = ceil((limit**1.5 - corner**1.5)/(1.5*c))
+    curved = (corner**1.5 + 1.5*c*arange(steps))**(2/3)
+    return append(concatenate((straight, curved)), limit)
+
+
+def cornu_points(rng: float = 20, tolerance: float = 1e-3,
+                 batch: int = 2**10, max_step: float = 0.05,
+                 backend: str = None):
+    """
+    Generate the spiral for u from 0 outwards, in batches of points.
+
+    Each point is found from the last by integrating over the short
+    interval between them, so no integral is ever taken over a long,
+    rapidly oscillating range. Past u, the rest of the spiral winds
+    around its limit at a distance of about 1/(pi*u), so beyond
+    u = 2/(pi*tolerance) it lies within tolerance of the last point, and
+    the last batch ends there if that is sooner than rng. The other half
+    of the spiral is the reflection of this one through the origin.
+
+    Parameters
+    ----------
+    rng: float
+    largest u
+    tolerance: float
+    greatest distance between the spiral and the lines joining the
+    points.
+    batch: int
+    number of points per batch.
+    backend: str, optional
+    see common.executor
+
+    Yields
+    ------
+    (C, S) arrays
+    """
+    u = arc_length_samples(min(rng, 2/(pi*tolerance)), tolerance, max_step)
+    c, s = 0.0, 0.0
+    yield array([c]), array([s])
+    for first in range(1, len(u), batch):
+        chunk = u[first - 1:first + batch]
+        dc, ds = map_to_array_mp(fresnel_increment,
+                                 list(zip(chunk[:-1], chunk[1:])),
+                                 backend=backend)
+        xs, ys = c + cumsum(dc), s + cumsum(ds)
+        c, s = xs[-1], ys[-1]
+        yield xs, ys
+
+
+def plot_cornu_spiral(rng: float = 20, tolerance: float = 1e-3) -> None:
     """Produce a Cornu spiral with given range and resolution
 
     Parameters
     ----------
     rng: float64
     Range of the integration variable to cover
-    rate: int
-    Number of sampling points on the given range.
+    tolerance: float
+    Greatest distance of the plotted line from the spiral; see
+    cornu_points.
     """
-    samples = linspace(-rng, rng, rate)
+    batches = list(cornu_points(rng, tolerance))
+    x = concatenate([b[0] for b in batches])
+    y = concatenate([b[1] for b in batches])
     plt.figure()
-    y, _ = map_to_array_mp(fresnel_s, samples)
-    x, _ = map_to_array_mp(fresnel_c, samples)
-    plt.plot(x, y)
+    plt.plot(concatenate((-x[:0:-1], x)), concatenate((-y[:0:-1], y)))
     plt.xlabel('$C(u)$')
     plt.ylabel('$S(u)$')
     plt.title("The Cornu spiral\n "
@@ -2,14 +2,20 @@
 # c-basic-offset: 4; tab-width: 4; indent-tabs-mode: nil
 # vi: set shiftwidth=4 tabstop=4 expandtab
 # :indentSize=4:tabSize=4:noTabs=true
-from functools import partial
-from multiprocessing.pool import Pool
-import matplotlib.pyplot as plt
+from collections import namedtuple
+from functools import partial, reduce
+import sys
 from numpy import pi, sum, sin, exp, log, vectorize, average, std, fromfunction,\
-        polyfit, poly1d, sqrt
-from numpy.random import uniform as uniform
-from os.path import exists
+        polyfit, poly1d, sqrt, array, stack, outer, diagonal
+from numpy.random import uniform as uniform, randint, default_rng
+from os.path import exists, abspath, dirname
 from os import mkdir
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from common.executor import map_to_array, parallel_map
+from common.instrumentation import instrumented
+from common.precision import Estimate, compensated_sum, dtype_of, \
+    summation_error
+from common.plotting import plt
 
 
 # Core Task 1: Monte Carlo integration
@@ -23,6 +29,7 @@ def f_example(arg: float) -> float:
     return (10**6)*sin(sum(arg, axis=1))
 
 
+@instrumented(count=lambda fun, args, norm=1: len(args))
 def expect(fun: callable, args, norm: float = 1):
     """Compute expectation value.
 
@@ -39,10 +46,13 @@ def expect(fun: callable, args, norm: float = 1):
     return sum(fun(args))*norm
 
 
+@instrumented(count=lambda number_of_samples, *args, **kwargs:
+              number_of_samples)
 def monte_carlo_integrate(number_of_samples: int,
                           integrand: callable = f_example,
                           dimensionality_of_space: int = D,
-                          box_side_length: int = S, stats=False):
+                          box_side_length: int = S, stats=False,
+                          precision: str = 'double'):
     """
     Integrate a dimensionality_of_space-dimensional function on a box of size s.
 
@@ -59,6 +69,9 @@ def monte_carlo_integrate(number_of_samples: int,
     size of integration box.
     stats
     Whether to calculate the error as well as the value.
+    precision : str, optional
+    'single' to draw the samples and evaluate the integrand in float32;
+    see reduced_precision_integrate.
     Returns
     -------
     (integral, error): tuple(float, float)
@@ -67,6 +80,10 @@ def monte_carlo_integrate(number_of_samples: int,
     integral: float
 
     """
+    if precision != 'double':
+        return reduced_precision_integrate(
+            number_of_samples, integrand, dimensionality_of_space,
+            box_side_length, stats, precision)
     samples = uniform(low=0.0, high=box_side_length,
                       size=(number_of_samples + 1, dimensionality_of_space))
     volume = box_side_length**dimensionality_of_space
@@ -81,8 +98,148 @@ def monte_carlo_integrate(number_of_samples: int,
         return integral
 
 
+def reduced_precision_integrate(number_of_samples: int,
+                                integrand: callable = f_example,
+                                dimensionality_of_space: int = D,
+                                box_side_length: float = S, stats=False,
+                                precision: str = 'single',
+                                checked: int = 2**10) -> Estimate:
+    """
+    As monte_carlo_integrate, in reduced precision, with the sums
+    compensated. The integrand must keep to the precision of its
+    argument.
+
+    The usual result is returned as an Estimate. Its precision loss is
+    relative to the integral: the mean deviation of the integrand from
+    its double precision value, over the first checked samples, with its
+    own standard error, plus a bound on the rounding in the sums.
+    """
+    dtype = dtype_of(precision)
+    generator = default_rng(randint(2**62))
+    samples = generator.random((number_of_samples, dimensionality_of_space),
+                               dtype=dtype)
+    samples *= dtype(box_side_length)
+    volume = box_side_length**dimensionality_of_space
+    values = integrand(samples)
+    mean = float(compensated_sum(values))/number_of_samples
+    # Squares of the deviations from the mean, as in block_moments, so
+    # that the variance does not cancel out in single precision.
+    deviations = values - dtype(mean)
+    variance = float(compensated_sum(deviations*deviations)) / \
+        (number_of_samples - 1)
+    integral = mean*volume
+    error = volume*sqrt(variance/number_of_samples)
+
+    deviation = values[:checked] - integrand(samples[:checked].astype(float))
+    magnitude = abs(values[:checked]).mean()
+    loss = (abs(deviation.mean()) + deviation.std()/sqrt(len(deviation)) +
+            summation_error(magnitude, dtype))/abs(mean)
+    return Estimate((integral, error) if stats else integral, float(loss))
+
+
+MultipleIntegrals = namedtuple('MultipleIntegrals',
+                               ['integrals', 'errors', 'covariance'])
+MultipleIntegrals.__doc__ = """
+integrals : array
+one estimate per integrand.
+
+errors : array
+standard errors of the estimates.
+
+covariance : array
+of the estimates. The error in the difference between integrals i and j
+is sqrt(covariance[i, i] + covariance[j, j] - 2*covariance[i, j]),
+which is small for similar integrands, as they share their samples.
+"""
+
+
+def evaluate_all(integrands: list, samples) -> array:
+    """Values of each of integrands at samples, one column each."""
+    return stack([f(samples) for f in integrands], axis=1)
+
+
+def block_moments(size: int, integrand: callable,
+                  dimensionality_of_space: int, box_side_length: float):
+    """Number of samples, mean and sum of outer products of deviations
+    from the mean, of a vector-valued integrand over one block of
+    samples."""
+    samples = uniform(low=0.0, high=box_side_length,
+                      size=(size, dimensionality_of_space))
+    values = integrand(samples).reshape(size, -1)
+    mean = average(values, axis=0)
+    deviations = values - mean
+    return size, mean, deviations.T @ deviations
+
+
+def combine_moments(a, b):
+    """Moments of the union of two blocks, from those of each; summing
+    the deviations rather than the squares of the values avoids
+    cancellation."""
+    size_a, mean_a, comoment_a = a
+    size_b, mean_b, comoment_b = b
+    size = size_a + size_b
+    delta = mean_b - mean_a
+    return (size, mean_a + delta*size_b/size,
+            comoment_a + comoment_b + outer(delta, delta)*size_a*size_b/size)
+
+
+@instrumented(count=lambda number_of_samples, *args, **kwargs:
+              number_of_samples)
+def monte_carlo_integrate_many(number_of_samples: int, integrands,
+                               dimensionality_of_space: int = D,
+                               box_side_length: float = S,
+                               block: int = 2**16,
+                               backend: str = 'thread') -> MultipleIntegrals:
+    """
+    Integrate several functions over the same box, with the same samples.
+
+    Each block of samples is drawn once, and every integrand evaluated
+    on it, so that sampling is paid for once, and the estimates are
+    correlated: their differences are much more accurate than the
+    estimates themselves.
+
+    Parameters
+    ----------
+    number_of_samples : int
+    at least two, for the errors.
+    integrands : list or callable
+    functions of samples of shape (n, dimensionality_of_space), each
+    returning shape (n,), or one function returning shape (n, k).
+    dimensionality_of_space : int, optional
+    box_side_length : float, optional
+    block : int, optional
+    number of samples drawn and evaluated at a time.
+    backend : str, optional
+    see common.executor. The blocks are spread over a pool of threads by
+    default, which numpy integrands keep busy, and which accepts any
+    callable, lambdas included. With 'process', the integrands must be
+    picklable, e.g. module level functions or partials of them.
+
+    Returns
+    -------
+    MultipleIntegrals
+    """
+    if number_of_samples < 2:
+        raise ValueError('Need at least two samples, got ' +
+                         str(number_of_samples))
+    integrand = integrands if callable(integrands) else partial(
+        evaluate_all, list(integrands))
+    sizes = [block]*(number_of_samples//block)
+    if number_of_samples % block:
+        sizes.append(number_of_samples % block)
+    moments = parallel_map(partial(
+        block_moments, integrand=integrand,
+        dimensionality_of_space=dimensionality_of_space,
+        box_side_length=box_side_length), sizes, backend=backend)
+    size, mean, comoment = reduce(combine_moments, moments)
+    volume = box_side_length**dimensionality_of_space
+    covariance = volume**2*comoment/((size - 1)*size)
+    return MultipleIntegrals(volume*mean, sqrt(diagonal(covariance)),
+                             covariance)
+
+
 def find_best_value_mp(samples_per_iteration, num_of_iterations=25,
-                       stats=False):
+                       stats=False, backend=None):
     """
     Iterate over monte-carlo integrations to compute an estimate of error.
     Parameters
@@ -90,6 +247,8 @@ def find_best_value_mp(samples_per_iteration, num_of_iterations=25,
     samples_per_iteration: int
     num_of_iterations: int
     stats: bool
+    backend: str, optional
+    see common.executor
 
     Returns
     -------
@@ -97,11 +256,11 @@ def find_best_value_mp(samples_per_iteration, num_of_iterations=25,
     """
 
     data = [samples_per_iteration for _ in range(num_of_iterations)]
-    with Pool() as p:
-        xs = p.map(partial(monte_carlo_integrate, stats=stats), data)
+    xs = map_to_array(partial(monte_carlo_integrate, stats=stats), data,
+                      backend=backend)
     if stats:
-        integrals = [x[0] for x in xs]
-        theoretical_errors, norm = [x[1] for x in xs], sqrt(1)/num_of_iterations
+        integrals = xs[:, 0]
+        theoretical_errors, norm = xs[:, 1], sqrt(1)/num_of_iterations
         return average(integrals), std(integrals), average(
             theoretical_errors)*norm
     else:
@@ -192,8 +351,15 @@ def linear_fit_on_log_log(x_vector, y_vector):
     return label, y
 
 
-if __name__ == '__main__':
-    sample_sets = fromfunction(lambda i: 2**i, (13,), dtype=int)
-    table = tabulate_estimates(sample_sets, 40, with_stats=True)
+def investigate_convergence(number_of_sets: int = 13,
+                            iterations: int = 40) -> None:
+    """Tabulate estimates for 2**i samples, and plot their errors and
+    values."""
+    sample_sets = fromfunction(lambda i: 2**i, (number_of_sets,), dtype=int)
+    table = tabulate_estimates(sample_sets, iterations, with_stats=True)
     log_log_error_plot(sample_sets, table)
-    plot_integral_value(sample_sets, table)
\ No newline at end of file
+    plot_integral_value(sample_sets, table)
+
+
+if __name__ == '__main__':
+    investigate_convergence()
\ No newline at end of file
@@ -3,22 +3,30 @@
 # vi: set shiftwidth=4 tabstop=4 expandtab
 # :indentSize=4:tabSize=4:noTabs=true
 
-from numpy import linspace, sin, cos, pi, zeros, fmod
+from numpy import arange, sin, cos, pi, zeros, fmod, argmin, argmax, \
+    concatenate, unique, asarray, size, ones
 from scipy.integrate import odeint
-from matplotlib import pyplot as plt
+from scipy.sparse import diags
+import sys
+from os.path import abspath, dirname
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from common.instrumentation import instrumented
+from common.plotting import plt
 
 
 class MechanicalSystem:
     """
-    General mechanical 1D system.
+    General mechanical system of N degrees of freedom.
 
     A class definition of a general dynamical system, whose motion is
-    defined by a single second order ODE.
+    defined by N second order ODEs, coupled linearly.
 
-    It is assumed that the ODe has form
+    It is assumed that the ODEs have form
     $$
-    y'' = a_1(y') + a_0(y) + b(t)
+    y'' = a_1(y') + a_0(y) + b(t) + K y
     $$
+    where y is a vector, and a_1, a_0 act on each of its components.
+    With N = 1 and no coupling this is a single ODE.
 
     Attributes
     ----------
@@ -29,11 +37,22 @@ class MechanicalSystem:
     Coefficient of second derivative (restoring force)
 
     b :  function
-    Coefficient of free term (driving force)
+    Coefficient of free term (driving force). May return a scalar, or
+    one value per degree of freedom.
+
+    y0 : iterable
+    (y, y') at t = 0. Each is a number, or an array of N.
 
     ans :  function, optional
     Analytical solution if one is known
 
+    coupling : matrix, optional
+    K above, dense or scipy.sparse, of shape (N, N).
+
+    parameters : dict
+    Numerical values that fully determine a1, a0 and b, if known. Needed
+    to cache the simulation results.
+
     """
 
     y_name = 'y'
@@ -41,42 +60,61 @@ class MechanicalSystem:
     total_energy_stored = None
     initial_energy = 0
     y_unit = 'arb. units'
+    parameters = None
+    # Lines are decimated to about this many buckets before plotting.
+    display_points = 2000
 
     def __init__(self, a1: callable, a0: callable, b: callable, y0: iter,
-                 ans: callable = None):
+                 ans: callable = None, coupling=None):
         self.a1 = a1
         self.a0 = a0
         self.b = b
         self.y0 = y0
         self.ans = ans
+        self.coupling = coupling
+        self.degrees_of_freedom = size(y0)//2
         self.rate = 500
         self.samples = None
         self.simulation_data = None
+        self.derived = {}
 
-    def to_coupled_linear(self, y: tuple, t: float) -> list:
+    def initial_state(self):
+        """y0 as one flat array, (y_1 .. y_N, y'_1 .. y'_N)."""
+        return asarray(self.y0, dtype=float).ravel()
+
+    @instrumented()
+    def to_coupled_linear(self, y, t: float):
         r"""
-        Parse second order ODE to two first order coupled.
+        Parse second order ODEs to twice as many first order coupled.
 
-        One of those ODE's is just the definition of the new variable
-        as the derivative.
+        Half of those ODE's are just the definition of the new variables
+        as the derivatives.
 
         Parameters
         ----------
-        y : tuple
-        has form (\theta, \dot{\theta})
+        y : array
+        has form (\theta_1 .. \theta_N, \dot{\theta}_1 .. \dot{\theta}_N)
 
         t : numerical value
         placeholder variable for re-evaluating the functions
 
         Returns
         -------
-        out : list
-        [y[1], y[1] in terms of ODE]
+        out : array
+        [y[N:], y[N:] in terms of ODE]
 
         """
-        return [y[1], self.a1(y[1]) + self.a0(y[0]) + self.b(t)]
-
-    def simulate(self, rate=500, duration=10.0):
+        n = self.degrees_of_freedom
+        position, velocity = y[:n], y[n:]
+        acceleration = self.a1(velocity) + self.a0(position) + self.b(t)
+        if self.coupling is not None:
+            acceleration = acceleration + self.coupling @ position
+        return concatenate((velocity, acceleration))
+
+    @instrumented(count=lambda self, rate=500, duration=10.0, *args,
+                  **kwargs: int(rate*duration))
+    def simulate(self, rate=500, duration=10.0, cache=None,
+                 **solver_options):
         """
         Perform simulation with given parameters.
 
@@ -88,25 +126,76 @@ class MechanicalSystem:
         duration : int, optional
         How long to run simulation for in seconds
 
+        cache : SimulationCache, optional
+        Where to look up and store the results. Ignored if the system
+        has no parameters.
+
+        solver_options
+        Passed on to odeint.
+
         """
         self.rate = rate
-        self.samples = linspace(0, duration, rate*duration)
-        self.simulation_data = odeint(self.to_coupled_linear, self.y0,
-                                      self.samples)
+        self.derived = {}
+        self.samples = arange(int(rate*duration))/rate
+        if cache is not None and self.parameters is not None:
+            self.simulation_data = cache.lookup(self, self.samples,
+                                                solver_options)
+        else:
+            self.simulation_data = odeint(self.to_coupled_linear,
+                                          self.initial_state(), self.samples,
+                                          **solver_options)
+
+    def derive(self, name, compute):
+        """Evaluate compute() once per simulation, and remember it."""
+        if name not in self.derived:
+            self.derived[name] = compute()
+        return self.derived[name]
+
+    def positions(self):
+        """Simulated y, one column per degree of freedom."""
+        return self.simulation_data[:, :self.degrees_of_freedom]
+
+    def velocities(self):
+        """Simulated y', one column per degree of freedom."""
+        return self.simulation_data[:, self.degrees_of_freedom:]
+
+    def energy_lost(self):
+        """Fraction of the initial energy lost at each sample.
+
+        total_energy_stored is given the positions and velocities, and
+        may return either the total, or one term per degree of freedom,
+        which are added up."""
+        def compute():
+            if self.degrees_of_freedom == 1:
+                energy = self.total_energy_stored(self.simulation_data[:, 0],
+                                                  self.simulation_data[:, 1])
+            else:
+                energy = self.total_energy_stored(self.positions(),
+                                                  self.velocities())
+                if energy.ndim > 1:
+                    energy = energy.sum(axis=1)
+            return 1 - energy/self.initial_energy
+        return self.derive('energy_lost', compute)
+
+    def wrapped_phase(self, coordinate=0):
+        """Deflection brought into [-pi, pi)."""
+        return self.derive(('wrapped_phase', coordinate),
+                           lambda: overwrap(self.positions()[:, coordinate]))
 
     def draw(self, time_shown, show_analytical=False, painter=plt,
-             fmt='k', label=None):
+             fmt='k', label=None, coordinate=0):
+        """Plot the state of the current simulation. Self-explanatory"""
         if label is None:
             label = self.y_name + ' - numerical'
-        """Plot the state of the current simulation. Self-explanatory"""
         if self.simulation_data is None:
             print('Please run the simulation first. ')
         else:
             beg = int(time_shown[0]*self.rate)
             fin = int(time_shown[1]*self.rate)
-            xs = self.samples[beg:fin]
-            ys = self.simulation_data[beg:fin, 0]
-            painter.plot(xs, ys, fmt, label=label)
+            ys = self.positions()[beg:fin, coordinate]
+            kept = decimate(ys, buckets=self.display_points)
+            xs = self.samples[beg:fin][kept]
+            painter.plot(xs, ys[kept], fmt, label=label)
             if show_analytical and self.ans is not None:
                 yas = self.ans(xs)
                 painter.plot(xs, yas, 'b-',
@@ -117,25 +206,62 @@ class MechanicalSystem:
             print('Please run the simulation first')
         else:
             if self.total_energy_stored is not None:
-                xs = self.samples[:]
-                ys = self.simulation_data[:, 0]
-                yds = self.simulation_data[:, 1]
+                lost = self.energy_lost()
+                kept = decimate(lost, buckets=self.display_points)
+                xs = self.samples[kept]
                 energy = zeros(len(xs))
-                painter.plot(xs, 1 -
-                             self.total_energy_stored(ys, yds) /
-                             self.initial_energy,
+                painter.plot(xs, lost[kept],
                              'b', label=self.y_name + ' - numerical')
                 if show_analytical:
                     painter.plot(xs, energy, 'k-',
                                  label=self.y_name + ' - analytical')
 
-    def draw_phase_space_plot(self, painter=plt, label=''):
+    def draw_phase_space_plot(self, painter=plt, label='', coordinate=0):
         if self.simulation_data is None:
             print('Please run the simulation first')
         else:
-            painter.plot(overwrap(self.simulation_data[:,0]),
-                         self.simulation_data[
-                :,1], label=label)
+            theta = self.wrapped_phase(coordinate)
+            theta_dot = self.velocities()[:, coordinate]
+            kept = decimate(theta, theta_dot, buckets=self.display_points)
+            painter.plot(theta[kept], theta_dot[kept], label=label)
+
+
+def decimate(*series, buckets=2000):
+    """
+    Choose which samples to plot, so that nothing visible is lost.
+
+    The samples are split into buckets of consecutive points, and from
+    each the first one, and the smallest and largest of every series are
+    kept. A line through them has the same envelope as the full one.
+
+    Parameters
+    ----------
+    series : arrays
+    of equal length.
+
+    buckets : int, optional
+    Roughly the width of the plot in pixels. None keeps every sample.
+
+    Returns
+    -------
+    out : array
+    Sorted indices of the samples to keep.
+
+    """
+    n = len(series[0])
+    if buckets is None or n <= 4*buckets:
+        return arange(n)
+    width = n//buckets
+    whole = width*buckets
+    starts = arange(0, whole, width)
+    kept = [starts, [n - 1]]
+    for s in series:
+        blocks = s[:whole].reshape(buckets, width)
+        kept += [starts + argmin(blocks, axis=1),
+                 starts + argmax(blocks, axis=1)]
+        if whole < n:
+            kept += [[whole + argmin(s[whole:]), whole + argmax(s[whole:])]]
+    return unique(concatenate(kept))
 
 
 def overwrap(data):
@@ -171,8 +297,53 @@ class Pendulum(MechanicalSystem):
                                   lambda t: f*sin(w_d*t), y0,
                                   ans=lambda t: y0[0]*cos(w_0*t) + (
                                           y0[1]/w_0)*sin(w_0*t))
+        self.parameters = {'w_0': w_0, 'w_d': w_d, 'q': q, 'f': f}
         # Since we haven't made the small angle approximation,
         # need proper potential.
         self.total_energy_stored = lambda y, yd: (yd**2)/2 + (
                 w_0**2*(1 - cos(y)))
-        self.initial_energy = 1/2*(y0[1])**2 + w_0**2*(1 - cos(y0[0]))
\ No newline at end of file
+        self.initial_energy = 1/2*(y0[1])**2 + w_0**2*(1 - cos(y0[0]))
+
+
+class OscillatorChain(MechanicalSystem):
+    """
+    A type of Mechanical system: identical masses in a line, each joined
+    to its neighbours by identical springs, with the ends fixed.
+
+    Parameters
+    ----------
+    n : int
+    Number of masses
+    w_0 : float
+    Natural frequency of one mass between two fixed springs
+    q : float
+    Dissipation Constant
+    f : float
+    Driving Force coefficient, applied to the first mass only
+    w_d : float
+    Driving frequency
+    y0 : iterable, optional
+    (positions, velocities). Defaults to the first mass displaced by 0.01.
+
+    """
+    y_name = 'x'
+    ydot_name = r'$\dot{x}$'
+
+    def __init__(self, n=100, w_0=1, q=0, f=0, w_d=2/3, y0=None):
+        if y0 is None:
+            y0 = zeros((2, n))
+            y0[0, 0] = 0.01
+        # Each mass is pulled back by both of its springs, and towards
+        # its neighbours by one each.
+        coupling = diags([ones(n - 1), -2*ones(n), ones(n - 1)], [-1, 0, 1],
+                         format='csr')*(w_0**2/2)
+        driven = zeros(n)
+        driven[0] = 1
+        MechanicalSystem.__init__(self, lambda y_dot: -q*y_dot,
+                                  lambda y: 0, lambda t: f*sin(w_d*t)*driven,
+                                  y0, coupling=coupling)
+        self.parameters = {'n': n, 'w_0': w_0, 'q': q, 'f': f, 'w_d': w_d}
+        self.total_energy_stored = lambda y, yd: (yd**2).sum(axis=1)/2 - (
+                y*(coupling @ y.T).T).sum(axis=1)/2
+        y0 = asarray(y0, dtype=float)
+        self.initial_energy = self.total_energy_stored(y0[:1], y0[1:])[0]
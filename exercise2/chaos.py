@@ -0,0 +1,174 @@
+#!/usr/local/bin/python3
+# c-basic-offset: 4; tab-width: 4; indent-tabs-mode: nil
+# vi: set shiftwidth=4 tabstop=4 expandtab
+# :indentSize=4:tabSize=4:noTabs=true
+
+"""
+Quantitative tests for chaos in the driven damped pendulum.
+
+Rather than simulating one Pendulum at a time, many driving forces are
+integrated together as a single system of ODEs, along with the
+linearised (variational) equations for a small displacement from each
+trajectory. Sampling once per driving period gives the stroboscopic
+Poincare section, and renormalising the displacement at the same time
+gives the largest Lyapunov exponent.
+
+The pendulums integrated together share the solver's step sizes, so each
+result depends slightly on which others are in its batch. Periodic
+motion is not affected beyond the solver tolerance, but in the chaotic
+range such differences grow until the sections differ point by point,
+and the exponents by some 10%, about as much as a change of the solver
+tolerance makes. Batches are therefore of a fixed size, so that a scan
+gives the same numbers on any machine.
+"""
+
+import sys
+from functools import partial
+from math import ceil
+from os.path import abspath, dirname
+from numpy import array, asarray, sin, cos, pi, zeros, empty, log, sqrt, \
+    array_split, concatenate
+from scipy.integrate import odeint
+from MechanicalSystems import Pendulum
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from common.executor import parallel_map
+
+# Driving forces integrated as one system by scan.
+BATCH = 16
+
+
+def variational_equations(state, t, forces, w_0, w_d, q):
+    r"""
+    Equations of motion of len(forces) pendulums and their tangent
+    vectors, packed as (\theta, \dot{\theta}, \delta\theta,
+    \delta\dot{\theta}) for each.
+    """
+    theta, omega, d_theta, d_omega = state.reshape(4, -1)
+    return concatenate((omega,
+                        -q*omega - w_0**2*sin(theta) + forces*sin(w_d*t),
+                        d_omega,
+                        -w_0**2*cos(theta)*d_theta - q*d_omega))
+
+
+def strobe(forces, parameters, y0, transient=100, periods=200, steps=20,
+           **solver_options):
+    """
+    Integrate pendulums with the given driving forces, once per driving
+    period.
+
+    Parameters
+    ----------
+    forces : array
+    Driving force coefficients, one pendulum each.
+
+    parameters : dict
+    w_0, w_d and q, as in Pendulum.parameters.
+
+    y0 : iterable
+    Initial conditions, shared by all pendulums.
+
+    transient : int, optional
+    Number of driving periods to discard before recording.
+
+    periods : int, optional
+    Number of driving periods to record.
+
+    steps : int, optional
+    Output points per driving period handed to odeint. Only the last
+    one is kept, but they keep the solver step size in check.
+
+    solver_options
+    Passed on to odeint, e.g. rtol and atol.
+
+    Returns
+    -------
+    sections : array
+    shape (len(forces), periods, 2) of (theta, theta_dot), with theta
+    wrapped to [-pi, pi).
+
+    exponents : array
+    Largest Lyapunov exponent of each pendulum, per unit time.
+
+    """
+    forces = asarray(forces, dtype=float)
+    n = len(forces)
+    w_0, w_d, q = parameters['w_0'], parameters['w_d'], parameters['q']
+    period = 2*pi/w_d
+    state = zeros((4, n))
+    state[0], state[1] = y0[0], y0[1]
+    state[2] = 1/sqrt(2)
+    state[3] = 1/sqrt(2)
+    state = state.ravel()
+    sections = empty((n, periods, 2))
+    growth = zeros(n)
+    rhs = partial(variational_equations, forces=forces, w_0=w_0, w_d=w_d,
+                  q=q)
+    for k in range(transient + periods):
+        samples = period*(k + array(range(steps + 1))/steps)
+        state = odeint(rhs, state, samples,
+                       **solver_options)[-1].reshape(4, n)
+        norm = sqrt(state[2]**2 + state[3]**2)
+        state[2:] /= norm
+        if k >= transient:
+            growth += log(norm)
+            sections[:, k - transient, 0] = (state[0] + pi) % (2*pi) - pi
+            sections[:, k - transient, 1] = state[1]
+        state = state.ravel()
+    return sections, growth/(periods*period)
+
+
+def scan(forces, pendulum=None, transient=100, periods=200, processes=None,
+         batch=BATCH, **solver_options):
+    """
+    Poincare sections and Lyapunov exponents for a sweep of driving forces.
+
+    The forces are split into batches of the same size, each integrated
+    as a single vectorised system, and the batches are spread over the
+    pool.
+
+    Parameters
+    ----------
+    forces : iterable
+    Driving force coefficients to scan.
+
+    pendulum : Pendulum, optional
+    Supplies all other parameters and the initial conditions.
+
+    processes : int, optional
+    Number of worker processes. Defaults to the number of CPUs.
+
+    batch : int, optional
+    Most forces integrated together. The results depend on it in the
+    chaotic range, but not on the number of processes.
+
+    solver_options
+    Passed on to odeint.
+
+    Returns
+    -------
+    (sections, exponents) as returned by strobe.
+
+    """
+    if pendulum is None:
+        pendulum = Pendulum(q=0.5)
+    forces = asarray(forces, dtype=float)
+    number_of_batches = max(1, ceil(len(forces)/batch))
+    batches = [b for b in array_split(forces, number_of_batches) if len(b)]
+    work = partial(strobe, parameters=pendulum.parameters, y0=pendulum.y0,
+                   transient=transient, periods=periods, **solver_options)
+    results = parallel_map(work, batches, workers=processes, chunksize=1)
+    sections = concatenate([r[0] for r in results])
+    exponents = concatenate([r[1] for r in results])
+    return sections, exponents
+
+
+def lyapunov_exponents(forces, pendulum=None, transient=100, periods=200):
+    """Shorthand function."""
+    return scan(forces, pendulum, transient, periods)[1]
+
+
+def draw_bifurcation_diagram(forces, sections, painter, component=0):
+    """Plot the Poincare section at each driving force against it."""
+    forces = asarray(forces)
+    xs = forces.repeat(sections.shape[1])
+    painter.plot(xs, sections[:, :, component].ravel(), 'k,')
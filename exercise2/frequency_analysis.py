@@ -0,0 +1,200 @@
+#!/usr/local/bin/python3
+# c-basic-offset: 4; tab-width: 4; indent-tabs-mode: nil
+# vi: set shiftwidth=4 tabstop=4 expandtab
+# :indentSize=4:tabSize=4:noTabs=true
+
+"""
+Estimators of the period of oscillation of sampled signals.
+
+Every function accepts either a single series or a 2D array with one
+series per row, and works on all rows at once. They return a
+PeriodEstimate, with one entry per row.
+"""
+
+from collections import namedtuple
+from warnings import catch_warnings, simplefilter
+from numpy import atleast_2d, nonzero, arange, repeat, cumsum, full, nan, \
+    diff, nanmean, nanstd, hanning, argmax, take_along_axis, abs, log, \
+    newaxis, errstate, concatenate, zeros, logical_and, logical_or, \
+    isnan
+from numpy.fft import rfft, irfft
+
+PeriodEstimate = namedtuple('PeriodEstimate', ['mean', 'spread', 'periods'])
+PeriodEstimate.__doc__ = """
+Result of a period estimate, per series.
+
+mean : array
+Best estimate of the period, in seconds.
+
+spread : array
+Standard deviation of the per-cycle periods, or the resolution of the
+estimator where there are no cycles to compare.
+
+periods : array
+One row per series, of the individual periods found, padded with nan.
+"""
+
+
+def _parabolic_offset(left, centre, right):
+    """Offset of the vertex of a parabola through three equally spaced
+    points from the middle one, in units of the spacing; nan if it lies
+    beyond the outer two, as it does when the middle one is no maximum."""
+    denominator = left - 2*centre + right
+    with errstate(divide='ignore', invalid='ignore'):
+        offset = 0.5*(left - right)/denominator
+    offset[denominator == 0] = 0
+    offset[abs(offset) > 1] = nan
+    return offset
+
+
+def crossing_times(data, direction='up'):
+    """
+    Find the zero crossings of every series, interpolated linearly
+    between samples.
+
+    Parameters
+    ----------
+    data : array
+    one series, or one series per row.
+
+    direction : str, optional
+    'up', 'down' or 'both'
+
+    Returns
+    -------
+    out : array
+    One row per series, of fractional sample indices, padded with nan.
+
+    """
+    data = atleast_2d(data)
+    before, after = data[:, :-1], data[:, 1:]
+    up = logical_and(after >= 0, before < 0)
+    down = logical_and(after < 0, before >= 0)
+    mask = {'up': up, 'down': down, 'both': logical_or(up, down)}[direction]
+    rows, columns = nonzero(mask)
+    lo, hi = before[rows, columns], after[rows, columns]
+    times = columns - lo/(hi - lo)
+    counts = mask.sum(axis=1)
+    position = arange(len(rows)) - repeat(cumsum(counts) - counts, counts)
+    crossings = full((len(data), max(counts.max(initial=0), 1)), nan)
+    crossings[rows, position] = times
+    return crossings
+
+
+def from_crossings(data, sampling_rate=500, direction='up'):
+    """Estimate the period by the time between successive zero
+    crossings. Both directions count half a period each."""
+    crossings = crossing_times(data, direction)
+    cycle = 2 if direction == 'both' else 1
+    periods = cycle*diff(crossings, axis=1)/sampling_rate
+    if periods.shape[1] == 0:
+        periods = full((len(crossings), 1), nan)
+    with catch_warnings():
+        # Series with fewer than two crossings have no period.
+        simplefilter('ignore', RuntimeWarning)
+        return PeriodEstimate(nanmean(periods, axis=1),
+                              nanstd(periods, axis=1), periods)
+
+
+def from_fft(data, sampling_rate=500):
+    """Estimate the period from the highest peak in the spectrum, refined
+    by fitting a parabola to the log-magnitude around it."""
+    data = atleast_2d(data)
+    n = data.shape[1]
+    if n < 4:
+        # No frequency between the constant term and the highest one.
+        period = full(len(data), nan)
+        return PeriodEstimate(period, period.copy(), period[:, newaxis])
+    windowed = (data - data.mean(axis=1)[:, newaxis])*hanning(n)
+    spectrum = abs(rfft(windowed, axis=1))
+    spectrum[:, 0] = 0
+    peak = argmax(spectrum[:, 1:-1], axis=1) + 1
+    # A constant series has no spectrum to speak of.
+    flat = take_along_axis(spectrum, peak[:, newaxis], axis=1)[:, 0] == 0
+    with errstate(divide='ignore'):
+        magnitude = log(spectrum)
+    neighbours = concatenate([take_along_axis(
+        magnitude, (peak + i)[:, newaxis], axis=1) for i in (-1, 0, 1)],
+        axis=1)
+    neighbours[~(neighbours > -float('inf'))] = 0
+    offset = _parabolic_offset(*neighbours.T)
+    frequency = (peak + offset)*sampling_rate/n
+    period = 1/frequency
+    resolution = period**2*sampling_rate/(2*n)
+    period[flat] = nan
+    resolution[flat] = nan
+    return PeriodEstimate(period, resolution, period[:, newaxis])
+
+
+def _refined_peak(correlation, candidates):
+    """Lag of the first candidate maximum in each row, refined by a
+    parabola through its neighbours; nan where there is none."""
+    n = correlation.shape[1]
+    peak = argmax(candidates, axis=1).clip(1, n - 2)
+    neighbours = concatenate([take_along_axis(
+        correlation, (peak + i)[:, newaxis], axis=1) for i in (-1, 0, 1)],
+        axis=1)
+    lag = peak + _parabolic_offset(*neighbours.T)
+    lag[~candidates.any(axis=1)] = nan
+    return lag
+
+
+def from_autocorrelation(data, sampling_rate=500):
+    """Estimate the period from the first maximum of the autocorrelation
+    past its first zero. The spread is the difference between that lag
+    and the gap from it to the next maximum, two estimates of the period
+    which differ by about as much as they err, mostly due to the finite
+    length of the series."""
+    data = atleast_2d(data)
+    n = data.shape[1]
+    centred = data - data.mean(axis=1)[:, newaxis]
+    spectrum = rfft(centred, n=2*n, axis=1)
+    correlation = irfft(spectrum*spectrum.conjugate(), axis=1)[:, :n]
+    # Normalise for the shrinking overlap at larger lags.
+    correlation /= (n - arange(n))
+    slope = diff(correlation, axis=1)
+    rising = concatenate((zeros((len(data), 1), dtype=bool), slope > 0),
+                         axis=1)
+    # Where the series ends, whether the correlation falls is unknown.
+    falling = concatenate((slope <= 0, zeros((len(data), 1), dtype=bool)),
+                          axis=1)
+    past_zero = cumsum(correlation < 0, axis=1) > 0
+    candidates = logical_and(past_zero, logical_and(rising, falling))
+    first = _refined_peak(correlation, candidates)
+    with errstate(invalid='ignore'):
+        later = candidates & (arange(n) > 1.5*first[:, newaxis])
+    second = _refined_peak(correlation, later)
+    period = first/sampling_rate
+    spread = abs(second - 2*first)/sampling_rate
+    # Without a second maximum, only the resolution of the lag is known.
+    spread[isnan(second)] = 0.5/sampling_rate
+    spread[isnan(first)] = nan
+    return PeriodEstimate(period, spread, period[:, newaxis])
+
+
+METHODS = {'crossings': from_crossings,
+           'fft': from_fft,
+           'autocorrelation': from_autocorrelation}
+
+
+def estimate_period(data, sampling_rate=500, method='crossings'):
+    """
+    Estimate the period of every series in data.
+
+    Parameters
+    ----------
+    data : array
+    One series, or one series per row, sampled at sampling_rate.
+
+    sampling_rate : float, optional
+    Samples per second.
+
+    method : str, optional
+    One of 'crossings', 'fft' or 'autocorrelation'.
+
+    Returns
+    -------
+    out : PeriodEstimate
+
+    """
+    return METHODS[method](data, sampling_rate=sampling_rate)
@@ -3,11 +3,19 @@
 # vi: set shiftwidth=4 tabstop=4 expandtab
 # :indentSize=4:tabSize=4:noTabs=true
 
+import sys
 from genericpath import exists
 from os import mkdir
+from os.path import abspath, dirname
 from MechanicalSystems import Pendulum
-import matplotlib.pyplot as plt
-from numpy import pi, mean, diff, ravel, nonzero, logical_and, linspace
+from simulation_cache import SimulationCache
+from frequency_analysis import from_crossings
+from chaos import scan, draw_bifurcation_diagram
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from common.plotting import plt
+from numpy import pi, linspace, array
+
+cache = SimulationCache()
 
 
 def compare_with_theory(cycles=None, p=None, check=True, sampling_rate=500,
@@ -21,7 +29,8 @@ def compare_with_theory(cycles=None, p=None, check=True, sampling_rate=500,
     if bounds is None:
         bounds = [[t, t + 10] for t in [2*pi*x for x in cycles]]
 
-    p.simulate(rate=sampling_rate, duration=(cycles[-1] + 10.0)*2*pi)
+    p.simulate(rate=sampling_rate, duration=(cycles[-1] + 10.0)*2*pi,
+               cache=cache)
     fig, axes = plt.subplots(len(cycles))
     try:
         _ = iter(axes)
@@ -56,28 +65,28 @@ def freq_from_crossings(data, sampling_rate=500):
     """
     Estimate frequency by counting zero crossings.
 
-    Returns the most likely frequency in Hertz
+    Returns the most likely frequency in Hertz, or one per row if data
+    holds several series.
 
     """
-    indices, = nonzero(ravel(logical_and(data[1:] >= 0, data[:-1] < 0)))
-    crossings = [i - data[i]/(data[i + 1] - data[i]) for i in indices]
-    return sampling_rate/mean(diff(crossings))
+    periods = from_crossings(data, sampling_rate).mean
+    return 1/periods if data.ndim > 1 else 1/periods[0]
 
 
 def investigate_period_amplitude(at=pi/2):
     """"Plot period's dependence on initial conditions"""
     domain = linspace(0.0001, pi, 50)
-    period_from_position, period_from_velocity = [], []
     sampling_rate = 100
+    runs = []
     for i in domain:
         p = Pendulum(1, 2/3, 0, 0, [i, 0])
-        p.simulate(rate=sampling_rate, duration=100*2*pi)
-        position_data = p.simulation_data[:, 0]
-        velocity_data = p.simulation_data[:, 1]
-        period_from_position.append(
-            1/freq_from_crossings(position_data, sampling_rate))
-        period_from_velocity.append(
-            1/freq_from_crossings(velocity_data, sampling_rate))
+        p.simulate(rate=sampling_rate, duration=100*2*pi, cache=cache)
+        runs.append(p.simulation_data)
+    runs = array(runs)
+    period_from_position = 1/freq_from_crossings(runs[:, :, 0],
+                                                 sampling_rate)
+    period_from_velocity = 1/freq_from_crossings(runs[:, :, 1],
+                                                 sampling_rate)
     fig, ax = plt.subplots()
     plt.plot(domain, period_from_position[:], 'b.', label=r'from $\theta$')
     plt.plot(domain, period_from_velocity[:], 'k+', label=r'from $\dot{'
@@ -90,7 +99,7 @@ def investigate_period_amplitude(at=pi/2):
     plt.ylabel('Period / s')
 
     p = Pendulum(1, 2/3, 0, 0, [at, 0])
-    p.simulate(rate=500, duration=1000)
+    p.simulate(rate=500, duration=1000, cache=cache)
     ys = p.simulation_data[:, 1]  # Use velocities, because of zero offset
     period = 1/freq_from_crossings(ys, 500)
     plt.legend(loc='best')
@@ -113,7 +122,7 @@ def investigate_damping(qs=None, sampling_rate=500):
     plt.suptitle('Comparison of different damping regimes')
     for q, ax0, ax1 in zip(qs, axes[:, 0], axes[:, 1]):
         pend = Pendulum(q=q)
-        pend.simulate(rate=sampling_rate)
+        pend.simulate(rate=sampling_rate, cache=cache)
         length = max(qs)*1.71
         pend.draw([0, length], painter=ax0)
         ax0.set_title('q = ' + str(q), y=0.18, x=1.05)
@@ -139,7 +148,7 @@ def investigate_driving(fs=None, rate=500, filename='driving'):
     for f, ax0, ax1 in zip(fs, axes[:, 0], axes[:, 1]):
         p = Pendulum(f=f)
         time = 100
-        p.simulate(rate=rate, duration=time)
+        p.simulate(rate=rate, duration=time, cache=cache)
         sim_data = p.simulation_data[:, 1]
         data.append(1/freq_from_crossings(sim_data))
         ax0.set_title('f = ' + str(f), y=0.18, x=1.05)
@@ -166,8 +175,8 @@ def investigate_driving(fs=None, rate=500, filename='driving'):
 def investigate_sensitivity():
     p1 = Pendulum(1, 2/3, 0.5, 1.2, [0.2, 0])
     p2 = Pendulum(1, 2/3, 0.5, 1.2, [0.20001, 0])
-    p1.simulate(500, 1000)
-    p2.simulate(500, 1000)
+    p1.simulate(500, 1000, cache=cache)
+    p2.simulate(500, 1000, cache=cache)
     p1.draw([80, 100], fmt='r', label='0.2')
     p2.draw([80, 100], fmt='b', label=r'0.2 + $\epsilon$')
     plt.title('Comparison of solutions with different initial conditions')
@@ -187,11 +196,11 @@ def investigate_sensitivity():
 
 def investigate_chaos():
     p = Pendulum()
-    p.simulate(duration=100)
+    p.simulate(duration=100, cache=cache)
     p.draw_phase_space_plot(label='No damping')
     for q in [.2, 1, 1.5, 1.7, 1.8, 1.9, 2.0, 2.1, 2.2]:
         p = Pendulum(q=q)
-        p.simulate(duration=100)
+        p.simulate(duration=100, cache=cache)
         p.draw_phase_space_plot(label='q = ' + str(q))
     plt.legend(loc='best')
     plt.xlabel(Pendulum.y_name)
@@ -200,7 +209,7 @@ def investigate_chaos():
     plt.show()
     for f in [0, 0.02, 0.01, 0.03, 0.05]:
         p = Pendulum(f=f)
-        p.simulate(duration=100)
+        p.simulate(duration=100, cache=cache)
         p.draw_phase_space_plot(label='f =' + str(f))
     plt.xlabel(Pendulum.y_name)
     plt.ylabel(Pendulum.ydot_name)
@@ -209,7 +218,7 @@ def investigate_chaos():
     plt.show()
     for f in [0, 0.5]:
         p = Pendulum(f=f)
-        p.simulate(duration=100)
+        p.simulate(duration=100, cache=cache)
         p.draw_phase_space_plot(label='f =' + str(f))
     plt.xlabel(Pendulum.y_name)
     plt.ylabel(Pendulum.ydot_name)
@@ -218,6 +227,26 @@ def investigate_chaos():
     plt.show()
 
 
+def investigate_bifurcation(fs=None, q=0.5, y0=None):
+    """Bifurcation diagram and largest Lyapunov exponent as functions of
+    driving amplitude"""
+    if fs is None:
+        fs = linspace(0.9, 1.5, 400)
+    if y0 is None:
+        y0 = [0.2, 0]
+    sections, exponents = scan(fs, Pendulum(q=q, y0=y0))
+    fig, axes = plt.subplots(2, sharex=True)
+    plt.suptitle('Transition to chaos, q = ' + str(q))
+    draw_bifurcation_diagram(fs, sections, painter=axes[0])
+    axes[0].set_ylabel(r'$\theta$ at $t = 2\pi n / \omega_d$')
+    axes[1].plot(fs, exponents, 'k-')
+    axes[1].axhline(y=0, color='0.5', linestyle='--')
+    axes[1].set_ylabel(r'$\lambda_{max}$ / $s^{-1}$')
+    axes[1].set_xlabel('Driving amplitude / (rad $s^{-2}$)')
+    save_figure('bifurcation')
+    plt.show()
+
+
 if __name__ == '__main__':
     compare_with_theory()
     investigate_period_amplitude()
@@ -226,3 +255,4 @@ if __name__ == '__main__':
     investigate_driving([0.01, 0.02, 0.05, 0.1], filename='weak_driving')
     investigate_sensitivity()
     investigate_chaos()
+    investigate_bifurcation()
@@ -0,0 +1,120 @@
+#!/usr/local/bin/python3
+# c-basic-offset: 4; tab-width: 4; indent-tabs-mode: nil
+# vi: set shiftwidth=4 tabstop=4 expandtab
+# :indentSize=4:tabSize=4:noTabs=true
+
+from hashlib import sha1
+from json import dumps
+from os import listdir, makedirs, remove, replace, utime, fdopen
+from os.path import exists, getmtime, getsize, join
+from tempfile import mkstemp
+from numpy import load, savez
+from scipy.integrate import odeint
+
+
+class SimulationCache:
+    """
+    On-disk cache of simulation results.
+
+    Each entry is addressed by the hash of everything that determines a
+    trajectory: the type of system, its parameters, the initial
+    conditions, the sampling rate and the options passed to the solver.
+    The entry holds the longest run computed so far, so that a shorter
+    duration is a slice of it. A longer one is integrated again from the
+    start: continuing from the final state would give a slightly
+    different trajectory, which for a chaotic system soon diverges, and
+    the result would depend on the order in which durations were asked
+    for.
+
+    Attributes
+    ----------
+    directory : str
+    Where the entries are stored.
+
+    max_bytes : int
+    Once the entries exceed this size, the least recently used ones are
+    evicted.
+
+    """
+
+    def __init__(self, directory='.simulation_cache', max_bytes=2**28):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(system, rate, solver_options):
+        """Content hash of a simulation configuration, bar duration."""
+        description = {'system': type(system).__name__,
+                       'parameters': system.parameters,
+                       'y0': system.initial_state().tolist(),
+                       'rate': rate,
+                       'solver': solver_options}
+        return sha1(dumps(description, sort_keys=True,
+                          default=repr).encode()).hexdigest()
+
+    def path(self, key):
+        return join(self.directory, key + '.npz')
+
+    def lookup(self, system, samples, solver_options):
+        """
+        Return the simulation data of system evaluated at samples.
+
+        Parameters
+        ----------
+        system : MechanicalSystem
+        Must have parameters that identify it.
+
+        samples : array
+        Times, spaced by 1/system.rate, starting at zero.
+
+        solver_options : dict
+        Keyword arguments to odeint.
+
+        Returns
+        -------
+        out : array
+        same as odeint(system.to_coupled_linear, system.initial_state(),
+        samples)
+
+        """
+        file_name = self.path(self.key(system, system.rate, solver_options))
+        cached = None
+        if exists(file_name):
+            with load(file_name) as entry:
+                cached = entry['simulation_data']
+            utime(file_name)
+        if cached is not None and len(cached) >= len(samples):
+            return cached[:len(samples)]
+        data = odeint(system.to_coupled_linear, system.initial_state(),
+                      samples, **solver_options)
+        self.store(file_name, data)
+        return data
+
+    def store(self, file_name, data):
+        if not exists(self.directory):
+            makedirs(self.directory)
+        # Unique, so that processes storing the same entry do not clash.
+        handle, temporary = mkstemp(dir=self.directory, suffix='.tmp')
+        with fdopen(handle, 'wb') as f:
+            savez(f, simulation_data=data)
+        replace(temporary, file_name)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until under max_bytes."""
+        entries = [join(self.directory, name)
+                   for name in listdir(self.directory)
+                   if name.endswith('.npz')]
+        entries.sort(key=getmtime)
+        total = sum(getsize(e) for e in entries)
+        for e in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            total -= getsize(e)
+            remove(e)
+
+    def clear(self):
+        if exists(self.directory):
+            for name in listdir(self.directory):
+                if name.endswith('.npz'):
+                    remove(join(self.directory, name))
@@ -0,0 +1,205 @@
+#!/usr/local/bin/python3
+# c-basic-offset: 4; tab-width: 4; indent-tabs-mode: nil
+# vi: set shiftwidth=4 tabstop=4 expandtab
+# :indentSize=4:tabSize=4:noTabs=true
+
+"""
+Design of coaxial coil systems for a uniform field.
+
+The positions along the z axis, radii and currents of a set of circular
+coils are adjusted to minimise the spread of the field over a sphere
+around the origin, relative to the field at the origin. The field is
+evaluated for all points and segments at once with the exact segment
+kernel, and its derivatives with respect to every parameter are taken
+by complex step, which is exact to rounding. Several starting points
+are optimised in parallel, and the best result is kept.
+"""
+
+import sys
+from functools import partial
+from os.path import abspath, dirname
+from numpy import array, asarray, concatenate, linspace, meshgrid, zeros, \
+    vstack, argsort, einsum, full, where, inf
+from numpy.random import default_rng
+from scipy.optimize import minimize
+from helmholtz import CircularWire, finite_segment_field
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from common.executor import parallel_map
+
+STEP = 1e-20
+
+
+class CoilSystem:
+    """
+    Circular coils sharing the z axis.
+
+    Parameters
+    ----------
+    positions : iterable
+    z coordinates of the centres of the coils
+    radii : iterable
+    currents : iterable
+    resolution : int, optional
+    of each coil, as in CircularWire.
+    """
+
+    def __init__(self, positions, radii, currents, resolution: int = 2**5):
+        self.positions = asarray(positions)
+        self.radii = asarray(radii)
+        self.currents = asarray(currents)
+        self.resolution = resolution
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def parameters(self) -> array:
+        """positions, radii and currents, in one array."""
+        return concatenate((self.positions, self.radii, self.currents))
+
+    def with_parameters(self, parameters) -> 'CoilSystem':
+        n = len(self)
+        return CoilSystem(parameters[:n], parameters[n:2*n],
+                          parameters[2*n:], self.resolution)
+
+    def wires(self) -> list:
+        return [CircularWire(current=i, radius=r,
+                             centre_location=array([0, 0, z]),
+                             resolution=self.resolution, kernel='segment')
+                for z, r, i in zip(self.positions, self.radii, self.currents)]
+
+    def segment_arrays(self):
+        """Start points, end points and currents of every segment."""
+        arrays = [w.segment_arrays() for w in self.wires()]
+        return tuple(concatenate(a) for a in zip(*arrays))
+
+    def field(self, at) -> array:
+        return finite_segment_field(at, *self.segment_arrays())
+
+
+def target_points(radius: float, n: int = 7) -> array:
+    """
+    Points of an n*n*n grid inside a sphere around the origin, with the
+    origin first.
+    """
+    axis = linspace(-radius, radius, n)
+    grid = vstack([g.ravel() for g in meshgrid(axis, axis, axis)]).T
+    distance = einsum('ij,ij->i', grid, grid)
+    order = argsort(distance, kind='stable')
+    grid = grid[order][distance[order] <= radius**2]
+    if distance[order][0] > 0:
+        grid = vstack((zeros((1, 3)), grid))
+    return grid
+
+
+def non_uniformity(coils: CoilSystem, points: array):
+    """
+    Mean square deviation of the field over points from its value at
+    the first point, relative to that value squared.
+
+    Written without absolute values, so that it stays analytic in the
+    parameters for complex step differentiation.
+    """
+    b = coils.field(points)
+    deviation = b - b[0]
+    return (einsum('ij,ij->', deviation, deviation)/len(points)/
+            einsum('i,i->', b[0], b[0]))
+
+
+def objective(free_values, coils, free, points):
+    """Non-uniformity and its gradient with respect to the free
+    parameters."""
+    parameters = coils.parameters.astype(complex)
+    parameters[free] = free_values
+    value = non_uniformity(coils.with_parameters(parameters), points).real
+    gradient = zeros(len(free_values))
+    for k, index in enumerate(where(free)[0]):
+        stepped = parameters.copy()
+        stepped[index] += 1j*STEP
+        gradient[k] = non_uniformity(coils.with_parameters(stepped),
+                                     points).imag/STEP
+    return value, gradient
+
+
+def _scaled_objective(free_values, scale, *args):
+    value, gradient = objective(free_values, *args)
+    return value/scale, gradient/scale
+
+
+def _optimise_from(start, coils, free, points, bounds):
+    # The non-uniformity is tiny near the optimum, far below the absolute
+    # tolerances of L-BFGS-B, so it is measured relative to the start.
+    scale = objective(start, coils, free, points)[0] or 1.0
+    result = minimize(_scaled_objective, start,
+                      args=(scale, coils, free, points), jac=True,
+                      method='L-BFGS-B', bounds=bounds)
+    return result.fun*scale, result.x
+
+
+def optimise(coils: CoilSystem, target_radius: float = 0.1,
+             vary=('positions', 'radii', 'currents'), starts: int = 8,
+             spread: float = 0.2, seed: int = None, points: array = None,
+             backend: str = None):
+    """
+    Adjust a coil system for the most uniform field over a sphere.
+
+    Parameters
+    ----------
+    coils : CoilSystem
+    The initial design. The current of the first coil is held fixed,
+    since scaling every current leaves the uniformity unchanged.
+    target_radius : float, optional
+    radius of the sphere around the origin.
+    vary : iterable, optional
+    which of 'positions', 'radii' and 'currents' to adjust.
+    starts : int, optional
+    number of starting points; the first is the given design, the rest
+    are perturbed from it by up to spread, relative to the largest
+    radius.
+    points : array, optional
+    where to evaluate the field instead, the first being the reference.
+    backend : str, optional
+    see common.executor
+
+    Returns
+    -------
+    (CoilSystem, non-uniformity) of the best design found.
+    """
+    n = len(coils)
+    if points is None:
+        points = target_points(target_radius)
+    free = zeros(3*n, dtype=bool)
+    for k, name in enumerate(['positions', 'radii', 'currents']):
+        if name in vary:
+            free[k*n:(k + 1)*n] = True
+    free[2*n] = False
+    lower = concatenate((full(n, -inf), full(n, target_radius),
+                         full(n, -inf)))
+    bounds = [(low, None) for low in lower[free]]
+
+    initial = coils.parameters[free].astype(float)
+    generator = default_rng(seed)
+    scale = spread*coils.radii.max()
+    candidates = [initial] + [
+        (initial + generator.uniform(-scale, scale, len(initial))).clip(
+            lower[free]) for _ in range(starts - 1)]
+    results = parallel_map(partial(_optimise_from, coils=coils, free=free,
+                                   points=points, bounds=bounds),
+                           candidates, backend=backend, chunksize=1)
+    value, best = min(results, key=lambda r: r[0])
+    parameters = coils.parameters.astype(float)
+    parameters[free] = best
+    return coils.with_parameters(parameters), value
+
+
+if __name__ == '__main__':
+    # Two coils: the optimum is the Helmholtz spacing, equal to the radius.
+    pair, error = optimise(CoilSystem([-0.3, 0.3], [1, 1], [1, 1]),
+                           vary=['positions'], seed=0)
+    print('Pair at', pair.positions, 'non-uniformity', error)
+    # Four coils, everything free: a shim system for a larger volume.
+    four, error = optimise(CoilSystem([-1, -0.4, 0.4, 1], [1, 1, 1, 1],
+                                      [1, 1, 1, 1]),
+                           target_radius=0.3, seed=0)
+    print('Four coils at', four.positions, 'radii', four.radii,
+          'currents', four.currents, 'non-uniformity', error)
@@ -0,0 +1,292 @@
+#!/usr/local/bin/python3
+# c-basic-offset: 4; tab-width: 4; indent-tabs-mode: nil
+# vi: set shiftwidth=4 tabstop=4 expandtab
+# :indentSize=4:tabSize=4:noTabs=true
+
+"""
+Tracing of magnetic field lines.
+
+All field lines are advanced together, with an adaptive Bogacki-Shampine
+3(2) scheme in arc length, each with its own step size. The field comes
+from any callable taking points of shape (m, 3): DirectField sums the
+exact fields of the segments of a set of wires every time, and FieldMap
+evaluates them once on a grid and interpolates.
+"""
+
+import sys
+from collections import namedtuple
+from itertools import product
+from os.path import abspath, dirname
+from numpy import array, asarray, atleast_2d, concatenate, zeros, full, \
+    arange, sqrt, einsum, isfinite, all as all_of, any as any_of, \
+    argsort, split, cumsum, bincount, linspace, meshgrid, stack, floor, \
+    where, nan, errstate, minimum, maximum, newaxis, array_split
+from helmholtz import CircularWire, finite_segment_field, save_figure, plt
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from common.executor import parallel_map
+
+RUNNING, LEFT_DOMAIN, HIT_WIRE, CLOSED, MAX_LENGTH, STALLED = range(6)
+STATUS_NAMES = ['running', 'left domain', 'hit wire', 'closed',
+                'max length', 'stalled']
+
+FieldLines = namedtuple('FieldLines', ['lines', 'status', 'lengths'])
+FieldLines.__doc__ = """
+lines : list
+one array of shape (k, 3) per seed, of the points along the line.
+
+status : array
+why each line stopped, one of the constants above.
+
+lengths : array
+arc length of each line.
+"""
+
+
+def segment_arrays(wires):
+    """Start points, end points and currents of every segment of wires."""
+    arrays = [w.segment_arrays() for w in wires]
+    return tuple(concatenate(a) for a in zip(*arrays))
+
+
+def distance_to_segments(points, starts, ends):
+    """Distance from each point to the nearest of the segments."""
+    dl = ends - starts
+    r = points[:, newaxis, :] - starts[newaxis, :, :]
+    along = (einsum('psk,sk->ps', r, dl) /
+             einsum('sk,sk->s', dl, dl)).clip(0, 1)
+    r -= along[:, :, newaxis]*dl[newaxis, :, :]
+    return sqrt(einsum('psk,psk->ps', r, r).min(axis=1))
+
+
+class DirectField:
+    """Field of wires, summed over all of their segments at every call.
+    Every segment is treated as a finite straight wire."""
+
+    def __init__(self, wires):
+        self.starts, self.ends, self.currents = segment_arrays(wires)
+
+    def __call__(self, points):
+        return finite_segment_field(points, self.starts, self.ends,
+                                    self.currents)
+
+
+class FieldMap:
+    """
+    A field sampled once on a regular grid, and interpolated linearly.
+
+    Parameters
+    ----------
+    field : callable
+    low, high : float or array
+    corners of the box covered
+    n : int or array
+    number of grid points along each axis.
+    backend : str, optional
+    the grid is evaluated in chunks, spread over the pool of
+    common.executor; field must then be picklable.
+
+    Outside the box it is nan, which ends the lines that get there.
+    """
+
+    def __init__(self, field, low=-2., high=2., n=64, backend=None):
+        self.field = field
+        self.low = full(3, low, dtype=float)
+        self.n = full(3, n, dtype=int)
+        self.spacing = (full(3, high, dtype=float) - self.low)/(self.n - 1)
+        axes = [self.low[k] + self.spacing[k]*arange(self.n[k])
+                for k in range(3)]
+        grid = stack(meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+        chunks = array_split(grid, max(1, len(grid)//2**12))
+        self.values = concatenate(parallel_map(field, chunks, backend)
+                                  ).reshape(tuple(self.n) + (3,))
+
+    def __call__(self, points):
+        s = (asarray(points) - self.low)/self.spacing
+        outside = ~all_of((s >= 0) & (s <= self.n - 1), axis=1)
+        s[outside] = 0
+        i = floor(s).astype(int).clip(0, self.n - 2)
+        f = s - i
+        b = zeros(s.shape, dtype=self.values.dtype)
+        for corner in product((0, 1), repeat=3):
+            weight = where(corner, f, 1 - f).prod(axis=1)
+            b += weight[:, newaxis]*self.values[i[:, 0] + corner[0],
+                                                i[:, 1] + corner[1],
+                                                i[:, 2] + corner[2]]
+        b[outside] = nan
+        return b
+
+
+def _unit(b, sign):
+    """Unit vector along b; nan where it vanishes or is undefined."""
+    strength = sqrt(einsum('ij,ij->i', b, b))
+    with errstate(divide='ignore', invalid='ignore'):
+        return sign*b/strength[:, newaxis]
+
+
+def _direction(field, points, sign):
+    """Unit vector along the field."""
+    return _unit(field(points), sign)
+
+
+def _segments_of(field):
+    """Start and end points of the segments the field comes from, or
+    None if they are not known."""
+    if isinstance(field, FieldMap):
+        field = field.field
+    if isinstance(field, DirectField):
+        return field.starts, field.ends
+    return None
+
+
+def trace(field, seeds, step=0.05, tolerance=1e-4, max_step=None,
+          bounds=None, max_length=50., wires=None, wire_radius=0.01,
+          closure=None, max_steps=10**5, sign=1) -> FieldLines:
+    """
+    Follow the field lines through seeds, in the direction of the field
+    (sign=1) or against it (sign=-1).
+
+    Parameters
+    ----------
+    field : callable
+    B at points of shape (m, 3)
+    seeds : array
+    starting points, of shape (m, 3)
+    step : float, optional
+    initial step length
+    max_step : float, optional
+    longest step, so that the lines look smooth. Default: 10*step.
+    tolerance : float, optional
+    largest local error allowed in a step
+    bounds : (low, high), optional
+    box outside of which lines stop
+    max_length : float, optional
+    wires : iterable, optional
+    lines that come within wire_radius of any of their segments stop.
+    Default: the wires of a DirectField, or of one sampled by a
+    FieldMap.
+    closure : float, optional
+    a line that comes back within this distance of its seed, having
+    travelled at least ten times as far, is closed. Default: 2*step.
+
+    Returns
+    -------
+    FieldLines
+    """
+    seeds = atleast_2d(asarray(seeds, dtype=float))
+    m = len(seeds)
+    if closure is None:
+        closure = 2*step
+    if max_step is None:
+        max_step = 10*step
+    if wires is not None:
+        segments = segment_arrays(wires)[:2]
+    else:
+        segments = _segments_of(field)
+    x = seeds.copy()
+    h = full(m, float(step))
+    length = zeros(m)
+    status = zeros(m, dtype=int)
+    active = arange(m)
+    recorded_lines, recorded_points = [arange(m)], [seeds.copy()]
+
+    for _ in range(max_steps):
+        if len(active) == 0:
+            break
+        xa, ha = x[active], h[active, newaxis]
+        b = field(xa)
+        k1 = _unit(b, sign)
+        # Where the field is undefined, the line has left the domain.
+        stalled = ~all_of(isfinite(k1), axis=1) & all_of(isfinite(b), axis=1)
+        k2 = _direction(field, xa + ha*k1/2, sign)
+        k3 = _direction(field, xa + 3*ha*k2/4, sign)
+        y = xa + ha*(2*k1 + 3*k2 + 4*k3)/9
+        k4 = _direction(field, y, sign)
+        z = xa + ha*(7*k1/24 + k2/4 + k3/3 + k4/8)
+        error = sqrt(einsum('ij,ij->i', y - z, y - z))
+        with errstate(divide='ignore', invalid='ignore'):
+            factor = minimum(maximum(0.9*(tolerance/error)**(1/3), 0.2), 5.)
+        factor[~isfinite(factor)] = 5.
+        # A step that reaches where the field is undefined is taken, so
+        # that the line ends there.
+        accept = (error <= tolerance) | ~isfinite(error) | \
+            (ha[:, 0] < 1e-9*step)
+        h[active] = minimum(ha[:, 0]*factor, max_step)
+
+        done, reached = active[accept], y[accept]
+        # Only the points where the field is defined are kept.
+        inside = all_of(isfinite(reached), axis=1)
+        x[done[inside]] = reached[inside]
+        length[done[inside]] += ha[accept, 0][inside]
+        recorded_lines.append(done[inside])
+        recorded_points.append(reached[inside])
+
+        new = zeros(len(done), dtype=int)
+        new[~inside] = LEFT_DOMAIN
+        if bounds is not None:
+            outside = any_of((reached < bounds[0]) | (reached > bounds[1]),
+                             axis=1)
+            new[outside] = LEFT_DOMAIN
+        if segments is not None:
+            near = distance_to_segments(reached, *segments) < wire_radius
+            new[(new == RUNNING) & near] = HIT_WIRE
+        back = sqrt(einsum('ij,ij->i', reached - seeds[done],
+                           reached - seeds[done]))
+        new[(new == RUNNING) & (back < closure) &
+            (length[done] > 10*closure)] = CLOSED
+        new[(new == RUNNING) & (length[done] >= max_length)] = MAX_LENGTH
+        status[done] = new
+        status[active[stalled]] = STALLED
+        active = active[status[active] == RUNNING]
+
+    indices = concatenate(recorded_lines)
+    points = concatenate(recorded_points)
+    order = argsort(indices, kind='stable')
+    counts = bincount(indices, minlength=m)
+    lines = split(points[order], cumsum(counts)[:-1])
+    return FieldLines(lines, status, length)
+
+
+def trace_both_ways(field, seeds, **kwargs) -> FieldLines:
+    """Follow the field lines through seeds in both directions, and join
+    the halves. The status is that of the forward half, unless it is
+    closed."""
+    forward = trace(field, seeds, sign=1, **kwargs)
+    backward = trace(field, seeds, sign=-1, **kwargs)
+    lines = [f if s == CLOSED else concatenate((b[:0:-1], f))
+             for f, b, s in zip(forward.lines, backward.lines,
+                                forward.status)]
+    lengths = forward.lengths + (forward.status != CLOSED)*backward.lengths
+    return FieldLines(lines, forward.status, lengths)
+
+
+def plot_field_lines(coils=None, number_of_lines: int = 24,
+                     extent: float = 3., grid: int = 48) -> FieldLines:
+    """Plot field lines in the y-z plane, through seeds spread along the
+    y axis, for a given set of coils"""
+    if coils is None:
+        coils = [CircularWire(centre_location=array([0, 0, z]),
+                              kernel='segment', resolution=2**5)
+                 for z in [-0.5, 0.5]]
+    field = FieldMap(DirectField(coils), -extent, extent, grid)
+    seeds = zeros((number_of_lines, 3))
+    seeds[:, 1] = linspace(-0.95, 0.95, number_of_lines)
+    result = trace_both_ways(field, seeds, bounds=(-extent, extent),
+                             max_length=8*extent, step=extent/100,
+                             wires=coils)
+    plt.figure()
+    for line in result.lines:
+        plt.plot(line[:, 1], line[:, 2], 'k-', linewidth=0.5)
+    for c in coils:
+        z = c.centre_location[2]
+        plt.plot([-c.radius, c.radius], [z, z], 'ro')
+    plt.xlabel('y / m')
+    plt.ylabel('z / m')
+    plt.title('Field lines in the y-z plane')
+    plt.axis('equal')
+    save_figure(str(len(coils)) + '_coils_field_lines')
+    plt.show()
+    return result
+
+
+if __name__ == '__main__':
+    plot_field_lines()
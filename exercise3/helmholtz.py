@@ -5,11 +5,17 @@
 
 from functools import partial
 from genericpath import exists
-from multiprocessing.pool import Pool
-import matplotlib.pyplot as plt
+import sys
+from os.path import abspath, dirname
 from numpy import array, cross, dot, sqrt, pi, cos, sin, linspace, zeros, \
-    shape, meshgrid, vstack
+    shape, meshgrid, vstack, asarray, atleast_2d, einsum, errstate, where, \
+    newaxis, result_type, float32, nanmax
 from os import mkdir
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from common.executor import map_to_array
+from common.instrumentation import instrumented
+from common.precision import Estimate, compensated_sum, dtype_of
+from common.plotting import plt
 
 
 def save_figure(file_name):
@@ -25,6 +31,20 @@ class Wire:
     def __init__(self, segments=None):
         self.segments = segments
 
+    def straight_wires(self) -> list:
+        """The StraightWire objects the wire is made of."""
+        return self.segments
+
+    def segment_arrays(self):
+        """Start points, end points and currents of all segments, as
+        arrays of shape (n, 3), (n, 3) and (n,)."""
+        if getattr(self, '_segment_arrays', None) is None:
+            segments = [s for w in self.straight_wires() for s in w.segments]
+            self._segment_arrays = (array([s.start for s in segments]),
+                                    array([s.end for s in segments]),
+                                    array([s.current for s in segments]))
+        return self._segment_arrays
+
 
 class Segment:
     """Segment. Usually something for which the field can be directly
@@ -35,12 +55,29 @@ class Segment:
         self.dl = dl
         self.current = current
 
+    @property
+    def start(self) -> array:
+        """Segments are centred on r_0."""
+        return asarray(self.r_0) - asarray(self.dl)/2
+
+    @property
+    def end(self) -> array:
+        return asarray(self.r_0) + asarray(self.dl)/2
+
 
 class StraightWire(Wire):
-    """CLass for Straight wire. """
+    """CLass for Straight wire.
 
-    def __init__(self, current, dl, r_0):
+    kernel is 'point', to treat it as a current element at r_0, or
+    'segment', for the exact field of a straight wire of length |dl|
+    centred on r_0. """
+
+    def __init__(self, current, dl, r_0, kernel: str = 'point'):
         super().__init__([Segment(current=current, dl=dl, r_0=r_0)])
+        self.kernel = kernel
+
+    def straight_wires(self) -> list:
+        return [self]
 
 
 class CircularWire(Wire):
@@ -49,11 +86,12 @@ class CircularWire(Wire):
 
     def __init__(self, current=1, radius=1,
                  centre_location: array = array([0, 0, 0]),
-                 resolution: int = 2**6):
+                 resolution: int = 2**6, kernel: str = 'point'):
         self.current = current
         self.radius = radius
         self.centre_location = centre_location
         self.resolution = resolution
+        self.kernel = kernel
         super().__init__(list(self.populate_segments(resolution)))
 
     def populate_segments(self, resolution):
@@ -64,25 +102,40 @@ class CircularWire(Wire):
         Since we want to have imposable symmetries, the segments are
         produced not in succession but rather with the opposite first.
         This can cause underflow problems in rare cases.
+
+        With the 'segment' kernel, the segments form a closed polygon of
+        the same area as the circle, which cancels the leading error in
+        the field.
         """
         theta = pi/resolution
-        normal = array([0, self.radius, 0])
-        chord = array([-2*self.radius*sin(theta/2), 0, 0], )
+        if self.kernel == 'segment':
+            circumradius = self.radius*sqrt(theta/sin(theta))
+            normal = array([0, circumradius*cos(theta/2), 0])
+            chord = array([-2*circumradius*sin(theta/2), 0, 0], )
+        else:
+            normal = array([0, self.radius, 0])
+            chord = array([-2*self.radius*sin(theta/2), 0, 0], )
 
         cf = cos(theta)
         sf = sin(theta)
         rotation_matrix = array([[cf, -sf, 0], [sf, cf, 0], [0, 0, 1]], )
+        centre = asarray(self.centre_location)
         for i in range(0, resolution):
-            yield StraightWire(current=self.current, dl=chord, r_0=normal)
+            yield StraightWire(current=self.current, dl=chord,
+                               r_0=centre + normal, kernel=self.kernel)
             yield StraightWire(current=self.current, dl=-chord,
-                               r_0=-normal)
+                               r_0=centre - normal, kernel=self.kernel)
             chord = dot(rotation_matrix, chord)
             normal = dot(rotation_matrix, normal)
 
 
+@instrumented()
 def biot_savart(at, wire: StraightWire):
     """Evaluate field of straight wire segment"""
     seg = wire.segments[0]
+    if wire.kernel == 'segment':
+        return finite_segment_field(at, seg.start[newaxis], seg.end[newaxis],
+                                    array([seg.current]))
     dr = at - seg.r_0
     mod_r = sqrt(dot(dr, dr))
     if mod_r == 0:
@@ -90,17 +143,110 @@ def biot_savart(at, wire: StraightWire):
     return seg.current*cross(seg.dl, dr)/(4*pi*mod_r**3)
 
 
-def field(wire, position):
-    """Evaluate the field of a wire position position(s)."""
+def finite_segment_field(at, starts, ends, currents,
+                         block: int = 2**20) -> array:
+    """
+    Exact field of straight segments of wire, summed.
+
+    Vectorised over both the points and the segments, in blocks of
+    points so that no more than about block point-segment pairs are held
+    at once. Points on a segment (including its ends) get no
+    contribution from it, the same convention as for a current element.
+
+    Parameters
+    ----------
+    at : array
+    a point, or points of shape (m, 3)
+    starts, ends : array
+    of shape (n, 3)
+    currents : array
+    of shape (n,), flowing from start to end.
+
+    Returns
+    -------
+    Field at the point(s), of the same shape as at. Complex if any of the
+    arguments are, so that it can be differentiated by complex step, and
+    single precision if they all are, with the sum over the segments
+    compensated.
+    """
+    points = atleast_2d(at)
+    result = zeros(points.shape, dtype=result_type(points, starts, currents,
+                                                   1.))
+    step = max(1, block//len(starts))
+    dl = ends - starts
+    for first in range(0, len(points), step):
+        p = points[first:first + step, newaxis, :]
+        r1 = p - starts
+        r2 = p - ends
+        m1 = sqrt(einsum('ijk,ijk->ij', r1, r1))
+        m2 = sqrt(einsum('ijk,ijk->ij', r2, r2))
+        # r1 x r2, without the cancellation between two long vectors.
+        c = cross(dl, r1)
+        c2 = einsum('ijk,ijk->ij', c, c)
+        r12 = einsum('ijk,ijk->ij', r1, r2)
+        # 1/(m1*m2 + r1.r2) cancels out close to the segment, where it
+        # is written as (m1*m2 - r1.r2)/c2 instead, which cancels out far
+        # from it.
+        with errstate(divide='ignore', invalid='ignore'):
+            inverse = where(r12.real > 0, 1/(m1*m2 + r12),
+                            (m1*m2 - r12)/c2)
+            factor = where(c2.real > 0, currents*(m1 + m2)*inverse/(
+                    4*pi*m1*m2), 0)
+        if result.dtype == float32:
+            result[first:first + step] = compensated_sum(
+                factor[:, :, newaxis]*c, axis=1)
+        else:
+            result[first:first + step] = einsum('ij,ijk->ik', factor, c)
+    return result.reshape(shape(at))
+
+
+@instrumented(count=lambda wire, position, *args, **kwargs:
+              len(wire.segments)*(1 if shape(position) == (3,)
+                                  else len(position)))
+def field(wire, position, backend: str = None, precision: str = 'double'):
+    """Evaluate the field of a wire position position(s).
+
+    With precision='single' (segment kernel only), see
+    reduced_precision_field."""
+    if precision != 'double':
+        return reduced_precision_field(wire, position, precision)
+    if all(w.kernel == 'segment' for w in wire.straight_wires()):
+        # All at once; nothing to gain from a pool.
+        return finite_segment_field(asarray(position), *wire.segment_arrays())
     if shape(position) == (3,):
-        f = partial(biot_savart, position)
-        s = sum(map(f, wire.segments))
-        return s
+        return _field_at(wire, position)
     else:
-        fld = partial(field, wire)
-        with Pool() as p:
-            ans = p.map(fld, position)
-        return array(ans)
+        fld = partial(_field_at, wire)
+        return map_to_array(fld, position, backend=backend)
+
+
+def _field_at(wire, position):
+    """Field of wire at a single position. Not instrumented, so that the
+    points are counted once, by field, whichever thread evaluates them."""
+    return sum(map(partial(biot_savart, position), wire.straight_wires()))
+
+
+def reduced_precision_field(wire, position, precision: str = 'single',
+                            checked: int = 64) -> Estimate:
+    """
+    Field of a wire in reduced precision, as an Estimate whose precision
+    loss is the largest relative deviation from double precision found
+    at checked of the points, spread evenly.
+    """
+    if not all(w.kernel == 'segment' for w in wire.straight_wires()):
+        raise ValueError('Reduced precision needs the segment kernel')
+    dtype = dtype_of(precision)
+    arrays = wire.segment_arrays()
+    points = asarray(position, dtype=float)
+    value = finite_segment_field(points.astype(dtype),
+                                 *(a.astype(dtype) for a in arrays))
+    every = max(1, len(atleast_2d(points))//checked)
+    exact = finite_segment_field(atleast_2d(points)[::every], *arrays)
+    deviation = atleast_2d(value)[::every] - exact
+    with errstate(divide='ignore', invalid='ignore'):
+        relative = sqrt(einsum('ij,ij->i', deviation, deviation) /
+                        einsum('ij,ij->i', exact, exact))
+    return Estimate(value, float(nanmax(relative, initial=0)))
 
 
 def superimpose(wires, at):
@@ -117,12 +263,12 @@ def gen_z_spaced(low=0., high=2., number_of_samples=50):
     return m
 
 
-def single_coil_on_axis(resolutions=None):
+def single_coil_on_axis(resolutions=None, kernel: str = 'point'):
     """Investigate the agreement of theoretical prediction of on-axis
     field with numerical result"""
     if resolutions is None:
         resolutions = [2**r for r in [4, 6, 7, 10]]
-    ts = [CircularWire(resolution=r) for r in resolutions]
+    ts = [CircularWire(resolution=r, kernel=kernel) for r in resolutions]
     for t in ts:
         m = gen_z_spaced(number_of_samples=50)
         data = field(t, m)
@@ -199,11 +345,12 @@ def helmholtz_coils(d: float = 1/2) -> None:
     plt.title('Value of field for Helmholtz coils')
     plt.ylabel(r'$B_z$ / T')
     plt.xlabel('z / m')
-    plt.plot([-0.5, 0.5], [act, act], 'k+')
+    # The theoretical value, at the centre
+    plt.plot([0], [act], 'k+')
     save_figure('helmholtz_coils_on_axis')
     plt.show()
     print(yz_coil(25, wires, -.05, .05, reference_point=array([0, 0, 0])))
-    # 0.00419 T
+    # 8.8e-06 T
 
 
 def many_coils_on_axis(number: int = 3, d: float = 5) -> None:
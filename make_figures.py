@@ -0,0 +1,116 @@
+#!/usr/local/bin/python3
+# c-basic-offset: 4; tab-width: 4; indent-tabs-mode: nil
+# vi: set shiftwidth=4 tabstop=4 expandtab
+# :indentSize=4:tabSize=4:noTabs=true
+
+"""
+Regenerate every figure of every exercise, without opening windows.
+
+    python3 make_figures.py                  # compute, then render
+    python3 make_figures.py --compute-only   # only write the artifacts
+    python3 make_figures.py --render-only    # only draw the artifacts
+    python3 make_figures.py chaos coil       # only jobs matching these
+
+The computation runs first, one job at a time (each job spreads its own
+work over the executor's pool), with every plotting call recorded into
+<exercise>/artifacts/<job>.npz. Matplotlib is not imported during this
+stage. The artifacts are then drawn into <exercise>/figures/ in parallel
+worker processes, with the Agg backend.
+"""
+
+import sys
+from argparse import ArgumentParser
+from glob import glob
+from importlib import import_module
+from os import chdir, getcwd, makedirs
+from os.path import abspath, dirname, join
+from time import perf_counter
+
+root = dirname(abspath(__file__))
+sys.path.insert(0, root)
+# Before any pool is started, so that the workers can import the jobs too.
+for exercise in ['exercise1', 'exercise2', 'exercise3']:
+    sys.path.insert(0, join(root, exercise))
+
+from common.executor import parallel_map
+from common.plotting import start_recording, stop_recording, render
+
+# (exercise, module, function, args, kwargs), as run by each __main__
+JOBS = [
+    ('exercise1', 'cornu_spiral_plotter', 'plot_cornu_spiral', (), {}),
+    ('exercise1', 'cornu_spiral_plotter', 'plot_diffraction_patterns', (),
+     {}),
+    ('exercise1', 'monte_carlo_integrator', 'investigate_convergence', (),
+     {}),
+    ('exercise2', 'investigator', 'compare_with_theory', (), {}),
+    ('exercise2', 'investigator', 'investigate_period_amplitude', (), {}),
+    ('exercise2', 'investigator', 'investigate_damping', (), {}),
+    ('exercise2', 'investigator', 'investigate_driving', (), {}),
+    ('exercise2', 'investigator', 'investigate_driving',
+     ([0.01, 0.02, 0.05, 0.1],), {'filename': 'weak_driving'}),
+    ('exercise2', 'investigator', 'investigate_sensitivity', (), {}),
+    ('exercise2', 'investigator', 'investigate_chaos', (), {}),
+    ('exercise2', 'investigator', 'investigate_bifurcation', (), {}),
+    ('exercise3', 'helmholtz', 'single_coil_on_axis', (), {}),
+    ('exercise3', 'helmholtz', 'yz_coil', (25,), {}),
+    ('exercise3', 'helmholtz', 'helmholtz_coils', (), {}),
+    ('exercise3', 'helmholtz', 'investigate_many_coils', (), {}),
+    ('exercise3', 'field_lines', 'plot_field_lines', (), {}),
+]
+
+
+def artifact_path(index, job):
+    exercise, _, function, _, _ = job
+    return join(root, exercise, 'artifacts', f'{index:02d}-{function}.npz')
+
+
+def compute(index, job):
+    """Run one job with plotting recorded, and save the artifact."""
+    exercise, module, function, args, kwargs = job
+    directory = join(root, exercise)
+    previous = getcwd()
+    # The figures are saved relative to the exercise.
+    chdir(directory)
+    try:
+        start_recording()
+        try:
+            getattr(import_module(module), function)(*args, **kwargs)
+        finally:
+            recorder = stop_recording()
+        path = artifact_path(index, job)
+        makedirs(dirname(path), exist_ok=True)
+        recorder.save(path)
+    finally:
+        chdir(previous)
+    return path
+
+
+def selected(patterns):
+    return [(i, job) for i, job in enumerate(JOBS)
+            if not patterns or any(p in job[2] for p in patterns)]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('patterns', nargs='*',
+                        help='only jobs whose function name contains one')
+    stage = parser.add_mutually_exclusive_group()
+    stage.add_argument('--compute-only', action='store_true')
+    stage.add_argument('--render-only', action='store_true')
+    arguments = parser.parse_args()
+    jobs = selected(arguments.patterns)
+
+    if not arguments.render_only:
+        for index, job in jobs:
+            begin = perf_counter()
+            compute(index, job)
+            print(f'computed {job[0]}/{job[2]} '
+                  f'in {perf_counter() - begin:.1f} s')
+    if not arguments.compute_only:
+        paths = [artifact_path(index, job) for index, job in jobs]
+        if arguments.render_only:
+            paths = [p for p in paths if glob(p)]
+        begin = perf_counter()
+        parallel_map(render, paths, backend='process', chunksize=1)
+        print(f'rendered {len(paths)} artifacts '
+              f'in {perf_counter() - begin:.1f} s')